@@ -4,8 +4,16 @@ import AcqirisWrapper as Aq
 import InstrumentDriver
 from InstrumentConfig import InstrumentQuantity
 import numpy as np
+import os
+import sys
 # for long integer py2/py3 compatibility
 from builtins import int
+# shared demodulation kernels, located in the SignalDemodulation driver
+_DEMOD_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SignalDemodulation'))
+if _DEMOD_PATH not in sys.path:
+    sys.path.append(_DEMOD_PATH)
+import labber_demodulation_kernels as demodulation
 
 class Error(Exception):
     pass
@@ -363,28 +371,19 @@ class Driver(InstrumentDriver.InstrumentWorker):
         # get parameters
         dFreq = self.getValue('Modulation frequency')
         skipStart = self.getValue('Skip start')
-        skipIndex = int(round(skipStart/self.dt))
         nTotLength = self.lTrace[0].size
-        length = 1 + int(round(self.getValue('Length')/self.dt))
-        length = int(min(length, nTotLength//nSegment-skipIndex))
         bUseRef = bool(self.getValue('Use Ch2 as reference'))
         # define data to use, put in 2d array of segments
         vData = np.reshape(self.lTrace[0], (nSegment, int(nTotLength//nSegment)))
-        # calculate cos/sin vectors, allow segmenting
-        vTime = self.dt * (skipIndex + np.arange(length, dtype=float))
-        vCos = np.cos(2*np.pi * vTime * dFreq)
-        vSin = np.sin(2*np.pi * vTime * dFreq)
-        # calc I/Q
-        dI = 2. * np.trapz(vCos * vData[:,skipIndex:skipIndex+length]) / float(length-1)
-        dQ = 2. * np.trapz(vSin * vData[:,skipIndex:skipIndex+length]) / float(length-1)
-        signal = dI + 1j*dQ
+        vRef = None
         if bUseRef:
             vRef = np.reshape(self.lTrace[1], (nSegment, int(nTotLength//nSegment)))
-            dIref = 2. * np.trapz(vCos * vRef[:,skipIndex:skipIndex+length]) / float(length-1)
-            dQref = 2. * np.trapz(vSin * vRef[:,skipIndex:skipIndex+length]) / float(length-1)
-            # subtract the reference angle
-            dAngleRef = np.arctan2(dQref, dIref)
-            signal /= (np.cos(dAngleRef) + 1j*np.sin(dAngleRef))
+        # calc I/Q using shared demodulation kernels
+        signal = demodulation.demodulate(vData, self.dt, [dFreq], skipStart,
+                                         self.getValue('Length'), vRef)
+        if signal is None:
+            return np.zeros(nSegment, dtype=complex)
+        signal = signal[:,0]
 #        elif nSegment>1:
 #            # return absolute value if segmenting without reference
 #            signal = np.abs(signal)
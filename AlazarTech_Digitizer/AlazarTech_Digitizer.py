@@ -129,6 +129,7 @@ class Driver(InstrumentDriver.InstrumentWorker):
             nBuffer = int(self.getValue('Records per Buffer'))
             nMemSize = int(self.getValue('Max buffer size'))
             nMaxBuffer = int(self.getValue('Max number of buffers'))
+            nProcessBuffer = self.getProcessBuffers()
             # show status before starting acquisition
             self.reportStatus('Digitizer - Waiting for signal')
             # get data
@@ -139,7 +140,9 @@ class Driver(InstrumentDriver.InstrumentWorker):
                            funcProgress=self._callbackProgress,
                            firstTimeout=self.dComCfg['Timeout']+180.0,
                            bufferSize=nMemSize,
-                           maxBuffers=nMaxBuffer)
+                           maxBuffers=nMaxBuffer,
+                           nProcessBuffers=nProcessBuffer)
+            self.updateDMAStatistics()
             # re-shape data and place in trace buffer
             self.lTrace[0] = vCh1.reshape((n_seq, nSample))
             self.lTrace[1] = vCh2.reshape((n_seq, nSample))
@@ -268,6 +271,7 @@ class Driver(InstrumentDriver.InstrumentWorker):
         nBuffer = int(self.getValue('Records per Buffer'))
         nMemSize = int(self.getValue('Max buffer size'))
         nMaxBuffer = int(self.getValue('Max number of buffers'))
+        nProcessBuffer = self.getProcessBuffers()
         # in hardware trig mode, there is no noed to re-arm the card
         bArm = not hardware_trig
         # get data
@@ -276,7 +280,22 @@ class Driver(InstrumentDriver.InstrumentWorker):
                                          bConfig=False, bArm=bArm, bMeasure=True,
                                          funcStop=self.isStopped,
                                          bufferSize=nMemSize,
-                                         maxBuffers=nMaxBuffer)
+                                         maxBuffers=nMaxBuffer,
+                                         nProcessBuffers=nProcessBuffer)
+        self.updateDMAStatistics()
+
+
+    def getProcessBuffers(self):
+        """Number of buffers for overlapped processing, zero if disabled"""
+        if self.getValue('Overlap buffer processing'):
+            return int(self.getValue('Processing buffers'))
+        return 0
+
+
+    def updateDMAStatistics(self):
+        """Report throughput and buffer underruns of last DMA read"""
+        self.setValue('DMA throughput', self.dig.dThroughput)
+        self.setValue('Buffer underruns', self.dig.nUnderrun)
 
 
     def getTracesNonDMA(self):
@@ -1,6 +1,14 @@
-import ctypes, os
+import ctypes, os, sys
 from ctypes import c_int, c_uint8, c_uint16, c_uint32, c_int32, c_float, c_char_p, c_void_p, c_long, byref, windll
 import numpy as np
+import queue
+import threading
+# shared integer accumulation, located in the Keysight_PXI_Digitizer driver
+_SUMS_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Keysight_PXI_Digitizer'))
+if _SUMS_PATH not in sys.path:
+    sys.path.append(_SUMS_PATH)
+from labber_digitizer_sums import getSumDtype
 
 # add logger, to allow logging to Labber's instrument log 
 import logging
@@ -98,6 +106,9 @@ class AlazarTechDigitizer():
         self.dRange = {1: 0.4, 2: 0.4}
         self.buffers = []
         self.timeout = timeout
+        # statistics of last DMA read
+        self.nUnderrun = 0
+        self.dThroughput = 0.0
         # create a session id
         func = getattr(DLL, 'AlazarNumOfSystems')
         func.restype = U32 
@@ -265,8 +276,11 @@ class AlazarTechDigitizer():
     def readTracesDMA(self, bGetCh1, bGetCh2, nSamples, nRecord, nBuffer, nAverage=1,
                       bConfig=True, bArm=True, bMeasure=True,
                       funcStop=None, funcProgress=None, timeout=None, bufferSize=512,
-                      firstTimeout=None, maxBuffers=1024):
-        """read traces in NPT AutoDMA mode, convert to float, average to single trace"""
+                      firstTimeout=None, maxBuffers=1024, nProcessBuffers=0):
+        """read traces in NPT AutoDMA mode, convert to float, average to single trace.
+        If nProcessBuffers > 0, completed DMA buffers are copied to one of
+        nProcessBuffers buffers and re-posted directly, while the data is
+        averaged in a separate thread"""
         t0 = time.clock()
         lT = []
 
@@ -376,6 +390,7 @@ class AlazarTechDigitizer():
             return
 
         lT.append('Post: %.1f ms' % ((time.clock()-t0)*1000))
+        worker = None
         try:
             lT.append('Start: %.1f ms' % ((time.clock()-t0)*1000))
             buffersCompleted = 0
@@ -391,6 +406,60 @@ class AlazarTechDigitizer():
             range1 = self.dRange[1]/codeRange/16.
             range2 = self.dRange[2]/codeRange/16.
             offset = 16.*codeZero
+            # when averaging, sum raw codes as integers, scale at the end
+            dtype = getSumDtype(nAvPerBuffer * buffersPerAcquisition, 8 * bytesPerSample)
+            vSum = [np.zeros(nPtsOut, dtype=dtype), np.zeros(nPtsOut, dtype=dtype)]
+            nBufferSum = 0
+
+            def processBuffer(buf_truncated):
+                # reshape, sort and average data
+                if nAverage > 1:
+                    if channels == 1:
+                        rs = buf_truncated.reshape((nAvPerBuffer, nPtsOut))
+                        vSum[0] += rs.sum(0, dtype=dtype)
+                    elif channels == 2:
+                        rs = buf_truncated.reshape((nAvPerBuffer, nPtsOut))
+                        vSum[1] += rs.sum(0, dtype=dtype)
+                    elif channels == 3:
+                        rs = buf_truncated.reshape((nAvPerBuffer, nPtsOut, 2))
+                        vSum[0] += rs[:,:,0].sum(0, dtype=dtype)
+                        vSum[1] += rs[:,:,1].sum(0, dtype=dtype)
+                else:
+                    if channels == 1:
+                        vData[0] = range1 * (buf_truncated  - offset)
+                    elif channels == 2:
+                        vData[1] = range2 * (buf_truncated  - offset)
+                    elif channels == 3:
+                        rs = buf_truncated.reshape((nPtsOut, 2))
+                        vData[0] = range1 * (rs[:,0]  - offset)
+                        vData[1] = range2 * (rs[:,1]  - offset)
+
+            # start processing thread, with pool of buffers for data copies
+            self.nUnderrun = 0
+            if nProcessBuffers > 0:
+                qFree = queue.Queue()
+                qData = queue.Queue()
+                lError = []
+                for n in range(int(nProcessBuffers)):
+                    qFree.put(np.empty(bytesPerBuffer//bytesPerSample,
+                                       dtype=self.buffers[0].buffer.dtype))
+
+                def processQueue():
+                    while True:
+                        data = qData.get()
+                        if data is None:
+                            break
+                        try:
+                            if len(lError) == 0:
+                                processBuffer(data)
+                        except Exception as e:
+                            lError.append(e)
+                        qFree.put(data)
+
+                worker = threading.Thread(target=processQueue)
+                worker.daemon = True
+                worker.start()
+            tStart = time.clock()
 
             timeout_ms = int(firstTimeout*1000)
 
@@ -423,27 +492,20 @@ class AlazarTechDigitizer():
                 else:
                     buf_truncated = buf.buffer[:(bytesPerBuffer//bytesPerSample)]
 
-                # reshape, sort and average data
-                if nAverage > 1:
-                    if channels == 1:
-                        rs = buf_truncated.reshape((nAvPerBuffer, nPtsOut))
-                        vData[0] += range1 * (np.mean(rs, 0)  - offset)
-                    elif channels == 2:
-                        rs = buf_truncated.reshape((nAvPerBuffer, nPtsOut))
-                        vData[1] += range2 * (np.mean(rs, 0)  - offset)
-                    elif channels == 3:
-                        rs = buf_truncated.reshape((nAvPerBuffer, nPtsOut, 2))
-                        vData[0] += range1 * (np.mean(rs[:,:,0], 0)  - offset)
-                        vData[1] += range2 * (np.mean(rs[:,:,1], 0)  - offset)
+                if worker is None:
+                    processBuffer(buf_truncated)
                 else:
-                    if channels == 1:
-                        vData[0] = range1 * (buf_truncated  - offset)
-                    elif channels == 2:
-                        vData[1] = range2 * (buf_truncated  - offset)
-                    elif channels == 3:
-                        rs = buf_truncated.reshape((nPtsOut, 2))
-                        vData[0] = range1 * (rs[:,0]  - offset)
-                        vData[1] = range2 * (rs[:,1]  - offset)
+                    # copy data to free buffer, count underruns if the
+                    # processing thread is behind and the re-post is delayed
+                    try:
+                        data = qFree.get_nowait()
+                    except queue.Empty:
+                        self.nUnderrun += 1
+                        data = qFree.get()
+                    np.copyto(data, buf_truncated)
+                    qData.put(data)
+                if nAverage > 1:
+                    nBufferSum += 1
 
                 # lT.append('Sort/Avg: %.1f ms' % ((time.clock()-t0)*1000))
                 # log.info(str(lT))
@@ -462,7 +524,21 @@ class AlazarTechDigitizer():
                 self.AlazarAbortAsyncRead()
             except:
                 pass
+            # wait for processing thread to finish
+            if worker is not None:
+                qData.put(None)
+                worker.join()
             lT.append('Abort: %.1f ms' % ((time.clock()-t0)*1000))
+        if worker is not None and len(lError) > 0:
+            raise lError[0]
+        self.dThroughput = bytesTransferred / max(time.clock() - tStart, 1E-9)
+        lT.append('Throughput: %.1f MB/s, underruns: %d' % (self.dThroughput/1E6, self.nUnderrun))
+        # convert sums to voltage
+        if nBufferSum > 0:
+            if channels & 1:
+                vData[0] = range1 * (vSum[0] / float(nAvPerBuffer) - nBufferSum * offset)
+            if channels & 2:
+                vData[1] = range2 * (vSum[1] / float(nAvPerBuffer) - nBufferSum * offset)
         # normalize        
         # log.info('Average: %.1f ms' % np.mean(lAvTime))
         vData[0] /= buffersPerAcquisition
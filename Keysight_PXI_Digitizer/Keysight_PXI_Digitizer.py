@@ -6,6 +6,84 @@ from BaseDriver import LabberDriver, Error, IdError
 import keysightSD1
 
 import numpy as np
+import queue
+import threading
+import time
+
+from labber_digitizer_sums import getSumDtype
+
+
+def alignedArray(nPoints, dtype=np.int16, nAlign=4096):
+    """Allocate uninitialized 1D numpy array aligned to nAlign bytes"""
+    nByte = nPoints * np.dtype(dtype).itemsize
+    raw = np.empty(nByte + nAlign, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % nAlign
+    return raw[offset:(offset + nByte)].view(dtype)
+
+
+class DAQReader(threading.Thread):
+    """Background thread reading data from one digitizer channel.  Data is
+    read into a bounded pool of buffers, and completed buffers are passed to
+    the main thread through a queue.  The DAQ read releases the GIL, so
+    reading overlaps with processing in the main thread"""
+
+    def __init__(self, driver, nCh, lPoints, timeOut, nDepth=4):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.driver = driver
+        self.nCh = nCh
+        self.lPoints = lPoints
+        self.timeOut = timeOut
+        self.bStop = False
+        # statistics, bytes read and number of waits for a free buffer
+        self.nBytes = 0
+        self.nStall = 0
+        # pool of free buffers, and queue of buffers with data
+        nDepth = max(int(nDepth), 2)
+        nMax = max(lPoints) if len(lPoints) > 0 else 0
+        self.qFree = queue.Queue()
+        for n in range(nDepth):
+            self.qFree.put(driver.getBuffer(nCh, nMax, n + 1))
+        self.qData = queue.Queue()
+        self.buffer = None
+
+    def run(self):
+        try:
+            for nPoints in self.lPoints:
+                # get free buffer, count stalls if the consumer is behind
+                try:
+                    buffer = self.qFree.get_nowait()
+                except queue.Empty:
+                    self.nStall += 1
+                    buffer = self.qFree.get()
+                if self.bStop or buffer is None:
+                    break
+                data = self.driver.DAQread(
+                    self.driver.dig, self.driver.getHwCh(self.nCh), nPoints,
+                    self.timeOut, buffer[:nPoints])
+                self.nBytes += data.nbytes
+                self.qData.put((buffer, data))
+                # stop if no data
+                if data.size == 0:
+                    break
+        except Exception as e:
+            self.qData.put((None, e))
+
+    def get(self):
+        """Get next data array, the previous array is returned to the pool"""
+        if self.buffer is not None:
+            self.qFree.put(self.buffer)
+        (self.buffer, data) = self.qData.get()
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    def stop(self):
+        """Stop reading and wait for thread to finish"""
+        self.bStop = True
+        # unblock thread if waiting for a free buffer
+        self.qFree.put(None)
+        self.join()
 
 
 class Driver(LabberDriver):
@@ -50,6 +128,10 @@ class Driver(LabberDriver):
             self.nCh = 4
         # create list of sampled data
         self.lTrace = [np.array([])] * self.nCh
+        # pool of data buffers, re-used between calls to DAQread
+        self.dBuffer = {}
+        # background reader threads, by channel
+        self.dReader = {}
         self.dig.openWithSlot(AWGPart, self.chassis, int(self.comCfg.address))
         # get hardware version - changes numbering of channels
         hw_version = self.dig.getHardwareVersion()
@@ -71,6 +153,8 @@ class Driver(LabberDriver):
         """Perform the close instrument connection operation"""
         # do not check for error if close was called with an error
         try:
+            # stop reader threads
+            self.stopReaders()
             # flush all memory
             for n in range(self.nCh):
                 self.log('Close ch:', n, self.dig.DAQflush(self.getHwCh(n)))
@@ -241,96 +325,145 @@ class Driver(LabberDriver):
         lScale = [(self.getRange(ch) / self.bitRange) for ch in range(self.nCh)]
         # keep track of progress in percent
         old_percent = 0
+        # sum raw data codes as integers, scale to voltage at the end
+        dtype = getSumDtype(nCycleTotal if nSeg <= 1 else nAv, self.nBit)
+        lSum = [None] * self.nCh
+        for nCh in lCh:
+            lSum[nCh] = np.zeros(nPts if nSeg <= 1 else nSeg * nPts, dtype=dtype)
 
-        # proceed depending on segment or not segment
-        if nSeg <= 1:
-            # non-segmented acquisiton
-            for n in range(nCall):
-                # number of cycles for this call, could be fewer for last call
-                nCycle = min(nCyclePerCall, nCycleTotal - (n * nCyclePerCall))
-
-                # report progress, only report integer percent
-                if nCall > 100:
-                    new_percent = int(100 * n / nCall)
-                    if new_percent > old_percent:
-                        old_percent = new_percent
-                        self.reportStatus(
-                            'Acquiring traces ({}%)'.format(new_percent))
-
-                # capture traces one by one
-                for nCh in lCh:
-                    # channel number depens on hardware version
-                    ch = self.getHwCh(nCh)
-                    data = self.DAQread(self.dig, ch, nPts * nCycle,
-                                        int(1000 + self.timeout_ms / nCall))
-                    # stop if no data
-                    if data.size == 0:
-                        return
-
-                    # average
-                    data = data.reshape((nCycle, nPts)).mean(0)
-                    # adjust scaling to account for summing averages
-                    scale = lScale[nCh] * (nCycle / nAv)
-                    # convert to voltage, add to total average
-                    self.lTrace[nCh] += data * scale
-
-                # break if stopped from outside
-                if self.isStopped():
-                    break
-                # lT.append('N: %d, Tot %.1f ms' % (n, 1000 * (time.clock() - t0)))
-
-        else:
-            # segmented acquisition, get caLls per segment
-            (nCallSeg, extra_call) = divmod(nSeg, nCyclePerCall)
-            # pre-calculate list of cycles/call, last call may have more cycles
-            if nCallSeg == 0:
-                nCallSeg = 1
-                lCyclesSeg = [nSeg]
-            else:
-                lCyclesSeg = [nCyclePerCall] * nCallSeg
-                lCyclesSeg[-1] = nCyclePerCall + extra_call
-            # pre-calculate scale, should include scaling for averaging
-            lScale = np.array(lScale, dtype=float) / nAv
-
-
-            for n in range(nAv):
-                # report progress, only report integer percent
-                if nAv > 1:
-                    new_percent = int(100 * n / nAv)
-                    if new_percent > old_percent:
-                        old_percent = new_percent
-                        self.reportStatus(
-                            'Acquiring traces ({}%)'.format(new_percent))
-
-                count = 0
-                # loop over number of calls per segment
-                for m, nCycle in enumerate(lCyclesSeg):
+        try:
+            # proceed depending on segment or not segment
+            if nSeg <= 1:
+                # non-segmented acquisiton
+                self.startReaders(lCh, [nPts * min(nCyclePerCall, nCycleTotal - (n * nCyclePerCall))
+                                        for n in range(nCall)],
+                                  int(1000 + self.timeout_ms / nCall))
+                for n in range(nCall):
+                    # number of cycles for this call, could be fewer for last call
+                    nCycle = min(nCyclePerCall, nCycleTotal - (n * nCyclePerCall))
+
+                    # report progress, only report integer percent
+                    if nCall > 100:
+                        new_percent = int(100 * n / nCall)
+                        if new_percent > old_percent:
+                            old_percent = new_percent
+                            self.reportStatus(
+                                'Acquiring traces ({}%)'.format(new_percent))
 
                     # capture traces one by one
                     for nCh in lCh:
-                        # channel number depens on hardware version
-                        ch = self.getHwCh(nCh)
-                        data = self.DAQread(self.dig, ch, nPts * nCycle,
-                                            int(1000 + self.timeout_ms / nCall))
+                        data = self.readData(nCh, nPts * nCycle,
+                                             int(1000 + self.timeout_ms / nCall))
                         # stop if no data
                         if data.size == 0:
+                            self.addSumToTraces(lSum, lScale, nAv)
                             return
-                        # store all data in one long vector
-                        self.lTrace[nCh][count:(count + data.size)] += \
-                            data * lScale[nCh]
 
-                    count += data.size
+                        # add to total sum
+                        lSum[nCh] += data.reshape((nCycle, nPts)).sum(0, dtype=dtype)
 
-                # break if stopped from outside
-                if self.isStopped():
-                    break
-
-                # lT.append('N: %d, Tot %.1f ms' % (n, 1000 * (time.clock() - t0)))
+                    # break if stopped from outside
+                    if self.isStopped():
+                        break
+                    # lT.append('N: %d, Tot %.1f ms' % (n, 1000 * (time.clock() - t0)))
 
+            else:
+                # segmented acquisition, get caLls per segment
+                (nCallSeg, extra_call) = divmod(nSeg, nCyclePerCall)
+                # pre-calculate list of cycles/call, last call may have more cycles
+                if nCallSeg == 0:
+                    nCallSeg = 1
+                    lCyclesSeg = [nSeg]
+                else:
+                    lCyclesSeg = [nCyclePerCall] * nCallSeg
+                    lCyclesSeg[-1] = nCyclePerCall + extra_call
+                self.startReaders(lCh, [nPts * nCycle for n in range(nAv)
+                                        for nCycle in lCyclesSeg],
+                                  int(1000 + self.timeout_ms / nCall))
+                for n in range(nAv):
+                    # report progress, only report integer percent
+                    if nAv > 1:
+                        new_percent = int(100 * n / nAv)
+                        if new_percent > old_percent:
+                            old_percent = new_percent
+                            self.reportStatus(
+                                'Acquiring traces ({}%)'.format(new_percent))
+
+                    count = 0
+                    # loop over number of calls per segment
+                    for m, nCycle in enumerate(lCyclesSeg):
+
+                        # capture traces one by one
+                        for nCh in lCh:
+                            data = self.readData(nCh, nPts * nCycle,
+                                                 int(1000 + self.timeout_ms / nCall))
+                            # stop if no data
+                            if data.size == 0:
+                                self.addSumToTraces(lSum, lScale, nAv)
+                                return
+                            # store all data in one long vector
+                            lSum[nCh][count:(count + data.size)] += data
+
+                        count += data.size
+
+                    # break if stopped from outside
+                    if self.isStopped():
+                        break
+
+                    # lT.append('N: %d, Tot %.1f ms' % (n, 1000 * (time.clock() - t0)))
+        finally:
+            # stop reader threads, also if acquisition failed
+            self.stopReaders()
+
+        self.addSumToTraces(lSum, lScale, nAv)
         # # log timing info
         # self.log(': '.join(lT))
 
 
+    def startReaders(self, lCh, lPoints, timeOut):
+        """Start background reader threads for all channels, if enabled.
+        lPoints is the list of number of points for each read"""
+        self.stopReaders()
+        if not self.getValue('Use reader threads'):
+            return
+        nDepth = int(self.getValue('Reader queue depth'))
+        for nCh in lCh:
+            self.dReader[nCh] = DAQReader(self, nCh, lPoints, timeOut, nDepth)
+        self.readerStart = time.time()
+        for reader in self.dReader.values():
+            reader.start()
+
+
+    def stopReaders(self):
+        """Stop reader threads, and report throughput and stall statistics"""
+        if len(self.dReader) == 0:
+            return
+        for reader in self.dReader.values():
+            reader.stop()
+        dTime = max(time.time() - self.readerStart, 1E-9)
+        nBytes = sum([reader.nBytes for reader in self.dReader.values()])
+        nStall = sum([reader.nStall for reader in self.dReader.values()])
+        self.dReader = {}
+        self.setValue('Reader throughput', nBytes / dTime)
+        self.setValue('Reader stalls', nStall)
+        self.log('Reader threads: %.1f MB/s, %d stalls' % (nBytes / dTime / 1E6, nStall))
+
+
+    def readData(self, nCh, nPoints, timeOut):
+        """Read data for channel, from reader thread if enabled"""
+        if nCh in self.dReader:
+            return self.dReader[nCh].get()
+        return self.DAQread(self.dig, self.getHwCh(nCh), nPoints, timeOut,
+                            self.getBuffer(nCh, nPoints))
+
+
+    def addSumToTraces(self, lSum, lScale, nAv):
+        """Convert sums of raw data to voltage, add average to traces"""
+        for nCh, vSum in enumerate(lSum):
+            if vSum is not None:
+                self.lTrace[nCh] += vSum * (lScale[nCh] / nAv)
+
+
     def getRange(self, ch):
         """Get channel range, as voltage.  Index start at 0"""
         rang = float(self.getCmdStringFromValue('Ch%d - Range' % (ch + 1)))
@@ -343,13 +476,32 @@ class Driver(LabberDriver):
         return rang
 
 
-    def DAQread(self, dig, nDAQ, nPoints, timeOut):
-        """Read data diretly to numpy array"""
+    def getBuffer(self, nCh, nPoints, nSlot=0):
+        """Get page-aligned int16 buffer with nPoints elements from the pool.
+        The buffer is re-used by the next call for the same channel and slot,
+        so data must be consumed before then"""
+        key = (nCh, nSlot)
+        buffer = self.dBuffer.get(key)
+        if buffer is None or buffer.size < nPoints:
+            buffer = alignedArray(nPoints, np.int16)
+            self.dBuffer[key] = buffer
+        return buffer[:nPoints]
+
+
+    def DAQread(self, dig, nDAQ, nPoints, timeOut, buffer=None):
+        """Read data diretly to numpy array.  If given, data is read into the
+        int16 array buffer, and a view of the buffer is returned"""
         if dig._SD_Object__handle > 0:
             if nPoints > 0:
-                data = (keysightSD1.c_short * nPoints)()
+                if buffer is None:
+                    data = (keysightSD1.c_short * nPoints)()
+                else:
+                    # ctypes array sharing memory with the numpy buffer
+                    data = np.ctypeslib.as_ctypes(buffer[:nPoints])
                 nPointsOut = dig._SD_Object__core_dll.SD_AIN_DAQread(dig._SD_Object__handle, nDAQ, data, nPoints, timeOut)
                 if nPointsOut > 0:
+                    if buffer is not None:
+                        return buffer[:nPoints]
                     return np.frombuffer(data, dtype=np.int16, count=nPoints)
                 else:
                     return np.array([], dtype=np.int16)
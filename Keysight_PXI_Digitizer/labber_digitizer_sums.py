@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+"""Integer accumulation of raw digitizer data, shared by the Keysight PXI and
+AlazarTech digitizer drivers.  Drivers in other folders add this folder to
+the python path before importing the module."""
+
+import numpy as np
+
+
+def getSumDtype(nTerm, nBit=16):
+    """Integer type for exact sums of nTerm samples with nBit resolution"""
+    return np.int32 if nTerm * 2**nBit < 2**31 else np.int64
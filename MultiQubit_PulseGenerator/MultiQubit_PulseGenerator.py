@@ -71,6 +71,22 @@ class Driver(LabberDriver):
             # the custom sequence class has to be named 'CustomSequence'
             if not isinstance(self.sequence, mod.CustomSequence):
                 self.sequence = mod.CustomSequence(1)
+
+        # store training data for matched-filter integration weights
+        elif (quant.name in ('Demodulation - Input', 'Demodulation - Input Q')
+              and self.getValue('Demodulation - Perform weight training')):
+            quant.setValue(value)
+            state = int(self.getValue('Demodulation - Training, input state'))
+            readout = self.sequence_to_waveforms.readout
+            readout.n_records = self.getValue('Demodulation - Number of records')
+            if self.getValue('Demodulation - IQ'):
+                if quant.name == 'Demodulation - Input Q':
+                    readout.add_training_trace(
+                        state, self.getValue('Demodulation - Input I'),
+                        self.getValue('Demodulation - Input Q'))
+            elif quant.name == 'Demodulation - Input':
+                readout.add_training_trace(
+                    state, self.getValue('Demodulation - Input'))
         return value
 
     def performGetValue(self, quant, options={}):
@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 # add logger, to allow logging to Labber's instrument log
+import itertools
 import logging
+import os
+import sys
 
 import numpy as np
 
+# shared demodulation kernels, located in the SignalDemodulation driver
+_DEMOD_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SignalDemodulation'))
+if _DEMOD_PATH not in sys.path:
+    sys.path.append(_DEMOD_PATH)
+import labber_demodulation_kernels as demodulation  # noqa: E402
+
 log = logging.getLogger('LabberDriver')
 
 
@@ -28,8 +38,16 @@ class Demodulation(object):
         self.demod_length = 1.0E-6
         self.freq_offset = 0.0
         self.use_phase_ref = False
+        # max number of segments processed at once, bounds memory usage
+        self.block_size = 4096
+
+        # matched-filter integration weights, trained from state 0/1 traces
+        self.use_weights = False
+        self.training_traces = [None, None]
 
-        # self.n_records = 1
+        self.n_records = 1
+        # cached kernels and demodulation results
+        self.clear_cache()
 
     def set_parameters(self, config={}):
         """Set base parameters using config from from Labber driver.
@@ -54,12 +72,19 @@ class Demodulation(object):
         self.use_phase_ref = config.get('Use phase reference signal')
         self.iq_ratio = config.get('Readout I/Q ratio')
         self.iq_skew = config.get('Readout IQ skew') * np.pi / 180
+        self.use_weights = (config.get('Demodulation - Integration weights',
+                                       'Box') == 'Matched filter')
         # number of records, will be remoevd in later version
         self.n_records = config.get('Demodulation - Number of records', 1)
+        # parameters may have changed, cached results are no longer valid
+        self.clear_cache()
 
     def demodulate(self, n, signal, ref=None):
         """Calculate complex signal from data and reference.
 
+        All qubits are demodulated in a single pass and the result is cached,
+        subsequent calls with the same input data are served from the cache.
+
         Parameters
         ----------
         n : int
@@ -77,57 +102,14 @@ class Demodulation(object):
             Complex array matching number of segments in input
 
         """
-        # get parameters
-        frequency = self.frequencies[n] - self.freq_offset
-        n_segment = int(self.n_records)
-        # get input data from dict, with keys {'y': value, 't0': t0, 'dt': dt}
-        if signal is None:
-            return np.zeros(n_segment, dtype=complex)
-        vY = signal['y']
-        dt = signal['dt']
-        # get shape of input data
-        shape = signal.get('shape', vY.shape)
-        # override segment parameter if input data has more than one dimension
-        if len(shape) > 1:
-            n_segment = shape[0]
-        # avoid exceptions if no time step is given
-        if dt == 0:
-            dt = 1.0
-        # get indices for data trimming
-        n0 = int(round(self.demod_skip / dt))
-        n_total = vY.size
-        length = 1 + int(round(self.demod_length / dt))
-        length = min(length, int(n_total / n_segment) - n0)
-        if length <= 1:
-            return np.zeros(n_segment, dtype=complex)
-
-        # define data to use, put in 2d array of segments
-        vData = np.reshape(vY, (n_segment, int(n_total / n_segment)))
-        # calculate cos/sin vectors, allow segmenting
-        vTime = dt * (n0 + np.arange(length, dtype=float))
-        vCos = np.cos(2 * np.pi * vTime * frequency)
-        vSin = np.sin(2 * np.pi * vTime * frequency)
-        # calc I/Q
-        dI = 2 * np.trapz(vCos * vData[:, n0:n0 + length]) / float(length - 1)
-        dQ = 2 * np.trapz(vSin * vData[:, n0:n0 + length]) / float(length - 1)
-        values = dI + 1j * dQ
-        if self.use_phase_ref and ref is not None:
-            # skip reference if trace length doesn't match
-            if len(ref['y']) != len(vY):
-                return values
-            vRef = np.reshape(ref['y'], (n_segment, int(n_total / n_segment)))
-            Iref = (2 * np.trapz(vCos * vRef[:, n0:n0 + length]) /
-                    float(length - 1))
-            Qref = (2 * np.trapz(vSin * vRef[:, n0:n0 + length]) /
-                    float(length - 1))
-            # subtract the reference angle
-            dAngleRef = np.arctan2(Qref, Iref)
-            values /= (np.cos(dAngleRef) + 1j * np.sin(dAngleRef))
-        return values
+        return self.demodulate_all(signal, ref)[n].copy()
 
     def demodulate_iq(self, n, signal_i, signal_q, ref=None):
         """Calculate complex signal from complex data and reference.
 
+        All qubits are demodulated in a single pass and the result is cached,
+        subsequent calls with the same input data are served from the cache.
+
         Parameters
         ----------
         n : int
@@ -148,56 +130,351 @@ class Demodulation(object):
             Complex array matching number of segments in input
 
         """
-        # get parameters
-        frequency = self.frequencies[n] - self.freq_offset
-        n_segment = int(self.n_records)
-        # get input data from dict, with keys {'y': value, 't0': t0, 'dt': dt}
+        return self.demodulate_iq_all(signal_i, signal_q, ref)[n].copy()
+
+    def demodulate_all(self, signal, ref=None):
+        """Calculate complex signal for all qubits from data and reference.
+
+        Parameters
+        ----------
+        signal : dict
+            Dictionary with signal data
+
+        ref : dict
+            Dictionary with reference data
+
+        Returns
+        -------
+        values : complex numpy array
+            Complex array with shape (n_qubit, n_segment)
+
+        """
+        if signal is None:
+            return np.zeros((self.n_qubit, int(self.n_records)), dtype=complex)
+        # check if data is already demodulated
+        key = (signal['y'], None, None if ref is None else ref['y'])
+        if self._is_cached(key):
+            return self._cache_values
+        vY = signal['y']
+        shape = signal.get('shape', vY.shape)
+        values = self._demodulate_traces(vY, shape, signal['dt'], ref, False)
+        self._set_cache(key, values)
+        return values
+
+    def demodulate_iq_all(self, signal_i, signal_q, ref=None):
+        """Calculate complex signal for all qubits from complex data.
+
+        Parameters
+        ----------
+        signal_i : dict
+            Dictionary with in-phase signal data
+
+        signal_q : dict
+            Dictionary with qudrature signal data
+
+        ref : dict
+            Dictionary with reference data
+
+        Returns
+        -------
+        values : complex numpy array
+            Complex array with shape (n_qubit, n_segment)
+
+        """
         if signal_i is None or signal_q is None:
-            return np.zeros(n_segment, dtype=complex)
+            return np.zeros((self.n_qubit, int(self.n_records)), dtype=complex)
+        # check if data is already demodulated
+        key = (signal_i['y'], signal_q['y'], None if ref is None else ref['y'])
+        if self._is_cached(key):
+            return self._cache_values
         vI = signal_i['y']
         vQ = signal_q['y']
         if vI.shape != vQ.shape:
             raise ValueError('I and Q must have the same shape.')
+        shape = signal_i.get('shape', vI.shape)
+        values = self._demodulate_traces(
+            (vI, vQ), shape, signal_i['dt'], ref, True)
+        self._set_cache(key, values)
+        return values
+
+    def add_training_trace(self, state, signal, signal_q=None):
+        """Store readout traces used for estimating integration weights.
+
+        The mean and variance over all segments are stored, the weights are
+        calculated from the difference between the state 0 and state 1 means.
+
+        Parameters
+        ----------
+        state : int
+            Qubit state of training data, 0 or 1
+
+        signal : dict
+            Dictionary with signal data, or in-phase data if signal_q is given
+
+        signal_q : dict
+            Dictionary with quadrature signal data, for I/Q demodulation
 
+        """
+        if signal is None:
+            return
+        vY = signal['y']
+        if signal_q is not None:
+            vY = vY + 1j * signal_q['y']
+        dt = signal['dt']
+        if dt == 0:
+            dt = 1.0
+        n_segment = int(self.n_records)
+        shape = signal.get('shape', vY.shape)
+        if len(shape) > 1:
+            n_segment = shape[0]
+        vData = np.reshape(vY, (n_segment, int(vY.size / n_segment)))
+        self.training_traces[int(state)] = demodulation.get_training_trace(
+            vData, dt)
+        # weights have changed, force kernels to be re-calculated
+        self.clear_cache()
+
+    def clear_training_traces(self):
+        """Remove stored training traces, reverting to box integration."""
+        self.training_traces = [None, None]
+        self.clear_cache()
+
+    def get_weights(self, dt, n0, length):
+        """Calculate matched-filter integration weights for all qubits.
+
+        The weights are calculated by the shared demodulation module, see
+        demodulation.get_weights.
+
+        Parameters
+        ----------
+        dt : float
+            Time step of input data
+
+        n0 : int
+            Index of first sample to include
+
+        length : int
+            Number of samples to include
+
+        Returns
+        -------
+        weights : complex numpy array or None
+            Weights with shape (length, n_qubit), or None if not available
+
+        """
+        if not self.use_weights or None in self.training_traces:
+            return None
+        weights = demodulation.get_weights(
+            self.training_traces[0], self.training_traces[1],
+            self.frequencies - self.freq_offset, dt, n0, length)
+        if weights is None:
+            log.warning('Training traces do not match input data, ' +
+                        'using box integration.')
+        return weights
+
+    def clear_cache(self):
+        """Clear cached demodulation results and kernels."""
+        self._cache_key = None
+        self._cache_values = None
+        self._kernel_key = None
+        self._kernel = None
+        self._kernel_real = None
+
+    def _is_cached(self, key):
+        """Check if demodulated values for the given input data are cached."""
+        if self._cache_key is None:
+            return False
+        # compare by identity, cache holds references to the input arrays
+        return all(x is y for (x, y) in zip(key, self._cache_key))
+
+    def _set_cache(self, key, values):
+        """Store demodulated values for the given input data."""
+        self._cache_key = key
+        self._cache_values = values
+
+    def _get_kernel(self, dt, n0, length, iq):
+        """Get demodulation kernel, with trapezoid weights folded in.
+
+        If matched-filter weights are available, they are also applied.
+
+        Parameters
+        ----------
+        dt : float
+            Time step of input data
+
+        n0 : int
+            Index of first sample to include
+
+        length : int
+            Number of samples to include
+
+        iq : bool
+            If True, return kernel for complex I/Q input data
+
+        Returns
+        -------
+        kernel : complex numpy array
+            Kernel with shape (length, n_qubit)
+
+        kernel_real : numpy array
+            Real and imaginary parts of kernel, shape (length, 2 * n_qubit)
+
+        """
+        frequencies = self.frequencies - self.freq_offset
+        key = (dt, n0, length, iq, tuple(frequencies), self.use_weights)
+        if key != self._kernel_key:
+            # cached kernel from shared library, no factor 2 for I/Q data
+            (kernel, kernel_real) = demodulation.get_kernel(
+                frequencies, dt, n0, length, scale=(1.0 if iq else 2.0))
+            # apply matched-filter weights, if available
+            weights = self.get_weights(dt, n0, length)
+            if weights is not None:
+                (kernel, kernel_real) = demodulation.apply_weights(
+                    kernel, weights)
+            self._kernel = kernel
+            self._kernel_real = kernel_real
+            self._kernel_key = key
+        return (self._kernel, self._kernel_real)
+
+    def _demodulate_blocks(self, blocks, ref_blocks, dt, n_sample, iq):
+        """Demodulate all qubits from blocks of records.
+
+        Parameters
+        ----------
+        blocks : iterable
+            Blocks of records, see demodulation.integrate_blocks
+
+        ref_blocks : iterable
+            Blocks of reference records, or None if not using reference
+
+        dt : float
+            Time step of input data
+
+        n_sample : int
+            Number of samples per record
+
+        iq : bool
+            If True, data is complex I/Q data
+
+        Returns
+        -------
+        values : complex numpy array
+            Complex array with shape (n_segment, n_qubit), or None if the
+            integration window is empty
+
+        """
+        (n0, length) = demodulation.get_indices(
+            dt, self.demod_skip, self.demod_length, n_sample)
+        if length <= 1:
+            return None
+        (kernel, kernel_real) = self._get_kernel(dt, n0, length, iq)
+        # calc I/Q for all qubits in one matrix product per block
+        values = demodulation.integrate_blocks(
+            blocks, kernel, kernel_real, n0, self.block_size)
+        if iq:
+            values = values.conj()
+        if ref_blocks is not None:
+            values_ref = demodulation.integrate_blocks(
+                ref_blocks, kernel, kernel_real, n0, self.block_size)
+            if iq:
+                values_ref = values_ref.conj()
+            # subtract the reference angle
+            demodulation.correct_phase(values, values_ref)
+        return values
+
+    def _demodulate_traces(self, vY, shape, dt, ref, iq):
+        """Demodulate all qubits from real or complex input data.
+
+        Parameters
+        ----------
+        vY : numpy array or tuple
+            Input data, real or complex, or tuple with (I, Q) data
+
+        shape : tuple
+            Shape of input data, used for getting number of segments
+
+        dt : float
+            Time step of input data
+
+        ref : dict
+            Dictionary with reference data
+
+        iq : bool
+            If True, data is complex I/Q data
+
+        Returns
+        -------
+        values : complex numpy array
+            Complex array with shape (n_qubit, n_segment)
+
+        """
+        n_segment = int(self.n_records)
         # override segment parameter if input data has more than one dimension
-        shape = signal_i.get('shape', vI.shape)
         if len(shape) > 1:
             n_segment = shape[0]
-        dt = signal_i['dt']
         # avoid exceptions if no time step is given
         if dt == 0:
             dt = 1.0
-        # get indices for data trimming
-        n0 = int(round(self.demod_skip / dt))
-        n_total = vI.size
-        length = 1 + int(round(self.demod_length / dt))
-        length = min(length, int(n_total / n_segment) - n0)
-        if length <= 1:
-            return np.zeros(n_segment, dtype=complex)
-
         # define data to use, put in 2d array of segments
-        vData = np.reshape(vI + 1j * vQ, (n_segment, int(n_total / n_segment)))
-        # calculate cos/sin vectors, allow segmenting
-        vTime = dt * (n0 + np.arange(length, dtype=float))
-        vS = np.exp(2j * np.pi * vTime * frequency)
-
-        # calc I/Q
-        dI = np.trapz((vS * vData[:, n0:n0 + length]).real) / float(length - 1)
-        dQ = -np.trapz((vS * vData[:, n0:n0 + length]).imag) / float(length - 1)
-        values = dI + 1j * dQ
+        n_total = (vY[0] if isinstance(vY, tuple) else vY).size
+        n_sample = int(n_total / n_segment)
+        if isinstance(vY, tuple):
+            vData = tuple(np.reshape(x, (n_segment, n_sample)) for x in vY)
+        else:
+            vData = np.reshape(vY, (n_segment, n_sample))
+        vRef = None
         if self.use_phase_ref and ref is not None:
             # skip reference if trace length doesn't match
-            if len(ref['y']) != len(vI):
-                return values
-            vRef = np.reshape(ref['y'], (n_segment, int(n_total / n_segment)))
-            Iref = (np.trapz((vS * vRef[:, n0:n0 + length]).real)
-                    / float(length - 1))
-            Qref = (-np.trapz((vS * vRef[:, n0:n0 + length]).imag)
-                    / float(length - 1))
-            # subtract the reference angle
-            dAngleRef = np.arctan2(Qref, Iref)
-            values /= (np.cos(dAngleRef) + 1j * np.sin(dAngleRef))
-        return values
+            if len(ref['y']) == n_total:
+                vRef = [np.reshape(ref['y'], (n_segment, n_sample))]
+        values = self._demodulate_blocks([vData], vRef, dt, n_sample, iq)
+        if values is None:
+            return np.zeros((self.n_qubit, n_segment), dtype=complex)
+        return np.ascontiguousarray(values.T)
+
+    def demodulate_stream(self, blocks, dt, ref_blocks=None, iq=False):
+        """Demodulate all qubits from an iterator of record blocks.
+
+        The records are processed block by block with bounded memory, giving
+        the same result as demodulating the full data set at once. The result
+        is not cached.
+
+        Parameters
+        ----------
+        blocks : iterable
+            Blocks of records, as 2D arrays with shape (n_records, n_samples)
+            or, if iq is True, as complex arrays or tuples of (I, Q) arrays
+
+        dt : float
+            Time step of input data
+
+        ref_blocks : iterable
+            Blocks of reference records, matching the signal blocks
+
+        iq : bool
+            If True, data is complex I/Q data
+
+        Returns
+        -------
+        values : complex numpy array
+            Complex array with shape (n_qubit, n_segment)
+
+        """
+        # avoid exceptions if no time step is given
+        if dt == 0:
+            dt = 1.0
+        # get record length from first block
+        blocks = iter(blocks)
+        first = next(blocks, None)
+        if first is None:
+            return np.zeros((self.n_qubit, 0), dtype=complex)
+        n_sample = (first[0] if isinstance(first, tuple) else first).shape[1]
+        if not self.use_phase_ref:
+            ref_blocks = None
+        values = self._demodulate_blocks(
+            itertools.chain([first], blocks), ref_blocks, dt, n_sample, iq)
+        if values is None:
+            return np.zeros((self.n_qubit, 0), dtype=complex)
+        return np.ascontiguousarray(values.T)
 
 
 if __name__ == '__main__':
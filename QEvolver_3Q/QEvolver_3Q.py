@@ -56,6 +56,21 @@ class Driver(InstrumentDriver.InstrumentWorker):
 				self.performSimulation()
 			value = quant.getTraceDict(self.SIM.final_pauli16, x0=0, dx=1)
 		#
+		elif quant.name in ['Final Pauli-16, All Inputs']:
+			if self.isConfigUpdated():
+				self.performSimulation()
+			value = quant.getTraceDict(self.SIM.final_pauli16_all, x0=0, dx=1)
+		#
+		elif quant.name in ['Process Matrix']:
+			if self.isConfigUpdated():
+				self.performSimulation()
+			value = quant.getTraceDict(self.SIM.process_ptm, x0=0, dx=1)
+		#
+		elif quant.name in ['Process Leakage']:
+			if self.isConfigUpdated():
+				self.performSimulation()
+			value = self.SIM.process_leakage
+		#
 		elif quant.name in lTraceStateOutput:
 			# output data, check if simulation needs to be performed
 			if self.isConfigUpdated():
@@ -100,7 +115,11 @@ class Driver(InstrumentDriver.InstrumentWorker):
 			self.bUseDensityMatrix = bool(CONFIG.get('Use Density Matrix'))
 		#
 		self.bShowTrace = bool(CONFIG.get('Show Trace'))
-		if self.bUseDensityMatrix:
+		if bool(CONFIG.get('Use Propagator')):
+			# evolve the logical basis once for all input states, no time traces
+			self.SIM.propagatorEvolver_3Q()
+			self.SIM.generateProcess()
+		elif self.bUseDensityMatrix:
 			self.SIM.rhoEvolver_3Q()
 			self.SIM.generateFinalRho()
 			if self.bShowTrace:
@@ -116,4 +116,47 @@ def	timeFunc_g23_pp(t,args=None):
 	return 0.5 * args.capCfg.r23 * np.sqrt(timeFunc_Q2_Frequency(t,args) * timeFunc_Q3_Frequency(t,args))
 
 def	timeFunc_g13_pp(t,args=None):
-	return 0.5 * args.capCfg.r13 * np.sqrt(timeFunc_Q1_Frequency(t,args) * timeFunc_Q3_Frequency(t,args))
\ No newline at end of file
+	return 0.5 * args.capCfg.r13 * np.sqrt(timeFunc_Q1_Frequency(t,args) * timeFunc_Q3_Frequency(t,args))
+
+### sampled sequences ###
+def add_pulse_array(t, pulseCfg):
+	# add single pulse, evaluated for an array of times
+	pulseCfg.Start = pulseCfg.PlateauStart - pulseCfg.Rise
+	pulseCfg.PlateauEnd = pulseCfg.PlateauStart + pulseCfg.Plateau
+	pulseCfg.End = pulseCfg.PlateauEnd + pulseCfg.Fall
+	y = np.zeros_like(t)
+	idx = (pulseCfg.Start <= t) & (t < pulseCfg.PlateauStart)
+	if np.any(idx):
+		y[idx] = add_rise(t[idx] - pulseCfg.PlateauStart, pulseCfg)
+	idx = (pulseCfg.PlateauStart <= t) & (t < pulseCfg.PlateauEnd)
+	y[idx] = 1
+	idx = (pulseCfg.PlateauEnd <= t) & (t < pulseCfg.End)
+	if np.any(idx):
+		y[idx] = add_fall(t[idx] - pulseCfg.PlateauEnd, pulseCfg)
+	return y * pulseCfg.Amplitude * np.cos(2 * np.pi * pulseCfg.Frequency * t + pulseCfg.Phase)
+
+def add_sequence_array(t, seqCfg):
+	# add a sequence, evaluated for an array of times
+	y = np.zeros_like(t)
+	for n in range(seqCfg.nPulses):
+		y += add_pulse_array(t, seqCfg.lpulseCfg[n])
+	return y
+
+def sample_timeFunc(t, args):
+	# sample all time functions for an array of times, in one pass.
+	# returns dict with same keys as the time function names
+	t = np.asarray(t, dtype=float)
+	dict_sample = {}
+	for sQubit in ['Q1', 'Q2', 'Q3']:
+		qubitCfg = getattr(args, 'qubitCfg_' + sQubit)
+		for sSeqType in ['Frequency', 'Anharmonicity', 'DriveP']:
+			y = add_sequence_array(t, getattr(args, 'seqCfg_' + sQubit + '_' + sSeqType))
+			if sSeqType != 'DriveP':
+				y += getattr(qubitCfg, sSeqType)
+			dict_sample['timeFunc_' + sQubit + '_' + sSeqType] = y
+	# coupling terms, from sampled frequencies
+	for (s1, s2) in [('1', '2'), ('2', '3'), ('1', '3')]:
+		r = getattr(args.capCfg, 'r' + s1 + s2)
+		dict_sample['timeFunc_g' + s1 + s2 + '_pp'] = 0.5 * r * np.sqrt(
+			dict_sample['timeFunc_Q' + s1 + '_Frequency'] * dict_sample['timeFunc_Q' + s2 + '_Frequency'])
+	return dict_sample
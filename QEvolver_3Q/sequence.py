@@ -124,12 +124,8 @@ class sequence():
 
 
 	def generateSeqDisplay(self):
-		#
-		for key, method in dict_timeFunc.items():
-			sName = 'Time Series: ' + key.replace('timeFunc_','').replace('_',' ')
-			self.dict_Seq[sName] = []
-		#
-		for key, method in dict_timeFunc.items():
+		# sample all time functions at once
+		dict_sample = sample_timeFunc(self.tlist, self)
+		for key in dict_timeFunc.keys():
 			sName = 'Time Series: ' + key.replace('timeFunc_','').replace('_',' ')
-			for t in self.tlist:
-				self.dict_Seq[sName].append(method(t,self))
+			self.dict_Seq[sName] = dict_sample[key]
@@ -3,10 +3,23 @@
 @author: Fei Yan
 """
 
+import os
+import sys
 import numpy as np
 from scipy.linalg import eig
 from qutip import *
 from basicfunc import *
+# shared operator factory, located in the QSolver driver
+_OPERATOR_PATH = os.path.abspath(os.path.join(
+	os.path.dirname(os.path.abspath(__file__)), os.pardir, 'QSolver'))
+if _OPERATOR_PATH not in sys.path:
+	sys.path.append(_OPERATOR_PATH)
+from labber_qubit_operators import generateBasicOperator, generateTensorOperator, generateLabelTable
+try:
+	# QuTiP 4, spline-interpolated coefficients on a uniform time grid
+	from qutip.interpolate import Cubic_Spline
+except ImportError:
+	Cubic_Spline = None
 
 import logging
 log = logging.getLogger('LabberDriver')
@@ -56,6 +69,13 @@ for k1 in range(4):
 		key = List_sPauli[k1] + List_sPauli[k2]
 		dict_pauli16[key] = Qflatten(tensor(List_mPauli[k1], List_mPauli[k2]))
 
+# input states for process tomography, all products of single-qubit states
+List_sInputState = ['+Z', '-Z', '+X', '+Y']
+List_sInput16 = [s1 + ',' + s2 for s1 in List_sInputState for s2 in List_sInputState]
+mRhoInput16 = np.array([(dict_psi[s1] * dict_psi[s1].dag()).full() for s1 in List_sInputState])
+mRhoInput16 = np.einsum('aij,bkl->abikjl', mRhoInput16, mRhoInput16).reshape((16, 4, 4))
+mPauli16 = np.array([op.full() for op in dict_pauli16.values()])
+
 
 
 def eigensolve(H):
@@ -82,16 +102,6 @@ def level_identify(vals, vecs, list_table, list_select):
 				break			
 	return vals[v_idx], vecs[:,v_idx]
 
-def generateBasicOperator(nTrunc):
-	# generate basic operators. matrix truncated at nTrunc 
-	I = qeye(nTrunc)
-	a = destroy(nTrunc)
-	x = a + a.dag()
-	p = -1j*(a - a.dag())
-	aa = a.dag() * a
-	aaaa = a.dag() * a.dag() * a * a
-	return {'I':I, 'a':a, 'x':x, 'p':p, 'aa':aa, 'aaaa':aaaa}
-
 
 class QubitConfiguration():
 
@@ -140,12 +150,7 @@ class simulation_3Q():
 		# generate capacitance network config.
 		self.capCfg = CapacitanceConfiguration(CONFIG)
 
-		List_sLabel = [str(n) for n in range(16)]
-		self.List_sLabel3 = []
-		for k1 in np.arange(self.nTrunc):
-			for k2 in np.arange(self.nTrunc):
-				for k3 in np.arange(self.nTrunc):
-					self.List_sLabel3.append(List_sLabel[k1] + List_sLabel[k2] + List_sLabel[k3])
+		self.List_sLabel3 = list(generateLabelTable(3, self.nTrunc))
 		self.list_label_sub = ['101','100','001','000']
 		self.list_label_sub_2Q = [s[0]+s[2] for s in self.list_label_sub]
 
@@ -175,6 +180,9 @@ class simulation_3Q():
 		### output quantities
 		self.final_state = []
 		self.final_pauli16 = []
+		self.final_pauli16_all = []
+		self.process_ptm = []
+		self.process_leakage = 0.0
 		self.dict_Trace_state = {'Time Series: a' + key: [] for key in self.list_label_sub_2Q}
 		self.dict_Trace_pauli16 = {'Time Series: ' + key: [] for key in dict_pauli16.keys()}
 
@@ -184,6 +192,10 @@ class simulation_3Q():
 		self.opts_mesolve = Options(atol=self.opts_mesolve_AbsTol,
 									rtol=self.opts_mesolve_RelTol,
 									nsteps=self.opts_mesolve_IntSteps)
+		# time-dependent coefficients, sampled on a fine time grid
+		# spline coefficients need QuTiP 4, otherwise use python callbacks
+		self.bUseSampledCoeff = bool(CONFIG.get('Use Sampled Coefficients', True)) and Cubic_Spline is not None
+		self.dCoeffSampleFreq = CONFIG.get('Coefficient Sampling Frequency', 100E9)
 
 
 
@@ -200,30 +212,30 @@ class simulation_3Q():
 		OP = generateBasicOperator(self.nTrunc)
 		self.OP = OP
 		# self Hamiltonian operators
-		self.H_Q1_aa = Qflatten(tensor(OP['aa'], OP['I'], OP['I']))
-		self.H_Q1_aaaa = Qflatten(tensor(OP['aaaa'], OP['I'], OP['I']))
-		self.H_Q2_aa = Qflatten(tensor(OP['I'], OP['aa'], OP['I']))
-		self.H_Q2_aaaa = Qflatten(tensor(OP['I'], OP['aaaa'], OP['I']))
-		self.H_Q3_aa = Qflatten(tensor(OP['I'], OP['I'], OP['aa']))
-		self.H_Q3_aaaa = Qflatten(tensor(OP['I'], OP['I'], OP['aaaa']))
+		self.H_Q1_aa = generateTensorOperator(self.nTrunc, 'aa', 'I', 'I')
+		self.H_Q1_aaaa = generateTensorOperator(self.nTrunc, 'aaaa', 'I', 'I')
+		self.H_Q2_aa = generateTensorOperator(self.nTrunc, 'I', 'aa', 'I')
+		self.H_Q2_aaaa = generateTensorOperator(self.nTrunc, 'I', 'aaaa', 'I')
+		self.H_Q3_aa = generateTensorOperator(self.nTrunc, 'I', 'I', 'aa')
+		self.H_Q3_aaaa = generateTensorOperator(self.nTrunc, 'I', 'I', 'aaaa')
 		# coupling Hamiltonian operators
-		self.H_g12_xx = Qflatten(tensor(OP['x'], OP['x'], OP['I']))
-		self.H_g23_xx = Qflatten(tensor(OP['I'], OP['x'], OP['x']))
-		self.H_g13_xx = Qflatten(tensor(OP['x'], OP['I'], OP['x']))
-		self.H_g12_pp = Qflatten(tensor(OP['p'], OP['p'], OP['I']))
-		self.H_g23_pp = Qflatten(tensor(OP['I'], OP['p'], OP['p']))
-		self.H_g13_pp = Qflatten(tensor(OP['p'], OP['I'], OP['p']))
+		self.H_g12_xx = generateTensorOperator(self.nTrunc, 'x', 'x', 'I')
+		self.H_g23_xx = generateTensorOperator(self.nTrunc, 'I', 'x', 'x')
+		self.H_g13_xx = generateTensorOperator(self.nTrunc, 'x', 'I', 'x')
+		self.H_g12_pp = generateTensorOperator(self.nTrunc, 'p', 'p', 'I')
+		self.H_g23_pp = generateTensorOperator(self.nTrunc, 'I', 'p', 'p')
+		self.H_g13_pp = generateTensorOperator(self.nTrunc, 'p', 'I', 'p')
 		# drive Hamiltonian operators
-		self.H_Q1_dr_x = Qflatten(tensor(OP['x'], OP['I'], OP['I']))
-		self.H_Q2_dr_x = Qflatten(tensor(OP['I'], OP['x'], OP['I']))
-		self.H_Q3_dr_x = Qflatten(tensor(OP['I'], OP['I'], OP['x']))
-		self.H_Q1_dr_p = Qflatten(tensor(OP['p'], OP['I'], OP['I']))
-		self.H_Q2_dr_p = Qflatten(tensor(OP['I'], OP['p'], OP['I']))
-		self.H_Q3_dr_p = Qflatten(tensor(OP['I'], OP['I'], OP['p']))
+		self.H_Q1_dr_x = generateTensorOperator(self.nTrunc, 'x', 'I', 'I')
+		self.H_Q2_dr_x = generateTensorOperator(self.nTrunc, 'I', 'x', 'I')
+		self.H_Q3_dr_x = generateTensorOperator(self.nTrunc, 'I', 'I', 'x')
+		self.H_Q1_dr_p = generateTensorOperator(self.nTrunc, 'p', 'I', 'I')
+		self.H_Q2_dr_p = generateTensorOperator(self.nTrunc, 'I', 'p', 'I')
+		self.H_Q3_dr_p = generateTensorOperator(self.nTrunc, 'I', 'I', 'p')
 		# collapse operators
-		self.L_Q1_a = Qflatten(tensor(OP['a'], OP['I'], OP['I']))
-		self.L_Q2_a = Qflatten(tensor(OP['I'], OP['a'], OP['I']))
-		self.L_Q3_a = Qflatten(tensor(OP['I'], OP['I'], OP['a']))
+		self.L_Q1_a = generateTensorOperator(self.nTrunc, 'a', 'I', 'I')
+		self.L_Q2_a = generateTensorOperator(self.nTrunc, 'I', 'a', 'I')
+		self.L_Q3_a = generateTensorOperator(self.nTrunc, 'I', 'I', 'a')
 
 
 	def generateHamiltonian_3Q_cap(self):
@@ -273,42 +285,100 @@ class simulation_3Q():
 		self.psi0 = self.psi_input_full_lab
 
 
+	def generateCoefficients(self):
+		# sample time-dependent coefficients once, on a fine time grid,
+		# to avoid python callbacks in the inner loop of the solver
+		nTime = int(max((self.dTimeEnd - self.dTimeStart) * self.dCoeffSampleFreq + 1, self.nTimeList))
+		self.tlist_coeff = np.linspace(self.dTimeStart, self.dTimeEnd, nTime)
+		self.dict_coeff = sample_timeFunc(self.tlist_coeff, self)
+
+
+	def generateTimeDependentH(self):
+		# list of operators and coefficients for the time-dependent Hamiltonian
+		lTerm = [
+			[2*np.pi*self.H_Q1_aa, 'timeFunc_Q1_Frequency'],
+			[2*np.pi*self.H_Q1_aaaa/2, 'timeFunc_Q1_Anharmonicity'],
+			[2*np.pi*self.H_Q2_aa, 'timeFunc_Q2_Frequency'],
+			[2*np.pi*self.H_Q2_aaaa/2, 'timeFunc_Q2_Anharmonicity'],
+			[2*np.pi*self.H_Q3_aa, 'timeFunc_Q3_Frequency'],
+			[2*np.pi*self.H_Q3_aaaa/2, 'timeFunc_Q3_Anharmonicity'],
+			[2*np.pi*self.H_g12_pp, 'timeFunc_g12_pp'],
+			[2*np.pi*self.H_g23_pp, 'timeFunc_g23_pp'],
+			[2*np.pi*self.H_g13_pp, 'timeFunc_g13_pp'],
+			[2*np.pi*self.H_Q1_dr_p, 'timeFunc_Q1_DriveP'],
+			[2*np.pi*self.H_Q2_dr_p, 'timeFunc_Q2_DriveP'],
+			[2*np.pi*self.H_Q3_dr_p, 'timeFunc_Q3_DriveP']
+			]
+		if not self.bUseSampledCoeff:
+			# python callbacks, evaluated at every solver step
+			return [[H, globals()[sFunc]] for H, sFunc in lTerm]
+		self.generateCoefficients()
+		t0, t1 = self.tlist_coeff[0], self.tlist_coeff[-1]
+		return [[H, Cubic_Spline(t0, t1, self.dict_coeff[sFunc])] for H, sFunc in lTerm]
+
+
+	def generateArgs(self):
+		# python callbacks read the pulse settings from self, sampled
+		# coefficients take no arguments (QobjEvo copies args as a dict)
+		if self.bUseSampledCoeff:
+			return {}
+		return self
+
+
 	def rhoEvolver_3Q(self):
 		#
-		self.result_rho = mesolve(H=[
-			[2*np.pi*self.H_Q1_aa, timeFunc_Q1_Frequency],
-			[2*np.pi*self.H_Q1_aaaa/2, timeFunc_Q1_Anharmonicity],
-			[2*np.pi*self.H_Q2_aa, timeFunc_Q2_Frequency],
-			[2*np.pi*self.H_Q2_aaaa/2, timeFunc_Q2_Anharmonicity],
-			[2*np.pi*self.H_Q3_aa, timeFunc_Q3_Frequency],
-			[2*np.pi*self.H_Q3_aaaa/2, timeFunc_Q3_Anharmonicity],
-			[2*np.pi*self.H_g12_pp, timeFunc_g12_pp],
-			[2*np.pi*self.H_g23_pp, timeFunc_g23_pp],
-			[2*np.pi*self.H_g13_pp, timeFunc_g13_pp],
-			[2*np.pi*self.H_Q1_dr_p, timeFunc_Q1_DriveP],
-			[2*np.pi*self.H_Q2_dr_p, timeFunc_Q2_DriveP],
-			[2*np.pi*self.H_Q3_dr_p, timeFunc_Q3_DriveP]
-			],
-			rho0 = self.rho0, tlist = self.tlist, c_ops = self.c_ops, args = self, options=self.opts_mesolve)#, options = options), store_states=True, c_ops=[], e_ops=[]
+		self.result_rho = mesolve(H=self.generateTimeDependentH(),
+			rho0 = self.rho0, tlist = self.tlist, c_ops = self.c_ops, args = self.generateArgs(), options=self.opts_mesolve)#, options = options), store_states=True, c_ops=[], e_ops=[]
 
 
 	def psiEvolver_3Q(self):
 		#2*np.pi*(self.H_Q1 + self.H_Q2 + self.H_Q3)
-		self.result_psi = mesolve(H=[
-			[2*np.pi*self.H_Q1_aa, timeFunc_Q1_Frequency],
-			[2*np.pi*self.H_Q1_aaaa/2, timeFunc_Q1_Anharmonicity],
-			[2*np.pi*self.H_Q2_aa, timeFunc_Q2_Frequency],
-			[2*np.pi*self.H_Q2_aaaa/2, timeFunc_Q2_Anharmonicity],
-			[2*np.pi*self.H_Q3_aa, timeFunc_Q3_Frequency],
-			[2*np.pi*self.H_Q3_aaaa/2, timeFunc_Q3_Anharmonicity],
-			[2*np.pi*self.H_g12_pp, timeFunc_g12_pp],
-			[2*np.pi*self.H_g23_pp, timeFunc_g23_pp],
-			[2*np.pi*self.H_g13_pp, timeFunc_g13_pp],
-			[2*np.pi*self.H_Q1_dr_p, timeFunc_Q1_DriveP],
-			[2*np.pi*self.H_Q2_dr_p, timeFunc_Q2_DriveP],
-			[2*np.pi*self.H_Q3_dr_p, timeFunc_Q3_DriveP]
-			],
-			rho0 = self.psi0, tlist = self.tlist, c_ops = [], args = self, options=self.opts_mesolve)
+		self.result_psi = mesolve(H=self.generateTimeDependentH(),
+			rho0 = self.psi0, tlist = self.tlist, c_ops = [], args = self.generateArgs(), options=self.opts_mesolve)
+
+
+	def propagatorEvolver_3Q(self):
+		# evolve the logical basis only, as dressed states in the lab frame.
+		# kets without collapse, otherwise the 16 operators |i><j|
+		R0 = np.diag(np.exp(-2j*np.pi*self.vals_idle_sub*self.tlist[0]))
+		W = np.dot(self.vecs_idle_sub, R0)
+		if len(self.c_ops) == 0:
+			lInput = [Qobj(W[:, [k]], dims=self.psi0.dims) for k in range(4)]
+		else:
+			# column-stacked order, input n = 4*j + i
+			lInput = [Qobj(np.outer(W[:, i], W[:, j].conj()), dims=self.rho0.dims)
+				for j in range(4) for i in range(4)]
+		H = self.generateTimeDependentH()
+		args = self.generateArgs()
+		self.result_prop = [mesolve(H=H, rho0=state, tlist=self.tlist, c_ops=self.c_ops,
+			args=args, options=self.opts_mesolve).states[-1].full() for state in lInput]
+
+
+	def generateProcess(self):
+		# logical process from the evolved basis, as superoperator on
+		# column-stacked density matrices in the rotating frame
+		R1 = np.diag(np.exp(-2j*np.pi*self.vals_idle_sub*self.tlist[-1]))
+		Z = np.dot(R1.conj().T, self.vecs_idle_sub.conj().T)
+		if len(self.result_prop) == 4:
+			A = np.dot(Z, np.hstack(self.result_prop))
+			L = np.kron(A.conj(), A)
+		else:
+			L = np.array([np.dot(Z, np.dot(rho, Z.conj().T)).flatten(order='F')
+				for rho in self.result_prop]).T
+		# apply to input state, tomography input states and Pauli operators at once
+		mIn = np.concatenate((self.rho_input_logic.full()[np.newaxis], mRhoInput16, mPauli16))
+		mOut = np.dot(mIn.transpose((0, 2, 1)).reshape((-1, 16)), L.T)
+		mOut = mOut.reshape((-1, 4, 4)).transpose((0, 2, 1))
+		# Pauli vectors for the input state and for all tomography input states
+		mPauliOut = np.real(np.einsum('kij,nji->nk', mPauli16, mOut[:17]))
+		self.final_state = mOut[0].flatten()
+		self.final_pauli16 = mPauliOut[0]
+		self.final_pauli16_all = mPauliOut[1:].flatten()
+		# Pauli transfer matrix, R_ij = Tr(P_i * Lambda(P_j)) / 4. The map is not
+		# trace preserving if population leaves the logical subspace, the
+		# average leakage is 1 - R_00
+		self.process_ptm = 0.25 * np.real(np.einsum('kij,nji->kn', mPauli16, mOut[17:])).flatten()
+		self.process_leakage = 1 - self.process_ptm[0]
 
 
 	def generateFinalRho(self):
@@ -321,13 +391,22 @@ class simulation_3Q():
 		log.info(self.final_state)
 
 
+	def getFramePhase(self):
+		# phase factors of the rotating frame for all times, shape (n_t, 4).
+		# H_idle_logic is diagonal, so U(2*pi*H_idle_logic, t).dag() is diag(phase)
+		return np.exp(2j*np.pi*np.outer(self.tlist, self.vals_idle_sub))
+
+
 	def generateTraceRho(self):
-		for k, t in enumerate(self.tlist):
-			rho_full_lab = self.result_rho.states[k]
-			rho_logic_lab = T(rho_full_lab, self.U_full_to_logic)
-			rho_logic = T(rho_logic_lab, U(2*np.pi*self.H_idle_logic, t).dag())
-			for key, op in dict_pauli16.items():
-				self.dict_Trace['Time Series: ' + key].append(np.real((op * rho_logic).tr()))
+		# logical states in rotating frame for all times, shape (n_t, 4, 4)
+		mRho = np.array([rho.full() for rho in self.result_rho.states])
+		mRho = np.matmul(np.matmul(self.vecs_idle_sub.conj().T, mRho), self.vecs_idle_sub)
+		mPhase = self.getFramePhase()
+		mRho *= mPhase[:, :, np.newaxis] * mPhase.conj()[:, np.newaxis, :]
+		# Pauli expectations, Tr(P * rho)
+		mPauli = np.real(np.einsum('kij,tji->kt', mPauli16, mRho))
+		for key, vPauli in zip(dict_pauli16.keys(), mPauli):
+			self.dict_Trace_pauli16['Time Series: ' + key] = vPauli
 
 
 	def generateFinalPsi(self):
@@ -339,11 +418,12 @@ class simulation_3Q():
 
 
 	def generateTracePsi(self):
-		for k, t in enumerate(self.tlist):
-			psi_full_lab = self.result_psi.states[k]
-			psi_logic_lab = self.U_full_to_logic * psi_full_lab
-			psi_logic = U(2*np.pi*self.H_idle_logic, t).dag() * psi_logic_lab
-			for k, key in enumerate(self.list_label_sub_2Q):
-				self.dict_Trace_state['Time Series: a' + key].append(psi_logic.full()[k,0])
-			for key, op in dict_pauli16.items():
-				self.dict_Trace_pauli16['Time Series: ' + key].append(np.real((op * psi_logic * psi_logic.dag()).tr()))
+		# logical states in rotating frame for all times, shape (n_t, 4)
+		mPsi = np.array([psi.full()[:, 0] for psi in self.result_psi.states])
+		mPsi = np.dot(mPsi, self.vecs_idle_sub.conj()) * self.getFramePhase()
+		for k, key in enumerate(self.list_label_sub_2Q):
+			self.dict_Trace_state['Time Series: a' + key] = mPsi[:, k]
+		# Pauli expectations, <psi|P|psi>
+		mPauli = np.real(np.einsum('ti,kij,tj->kt', mPsi.conj(), mPauli16, mPsi))
+		for key, vPauli in zip(dict_pauli16.keys(), mPauli):
+			self.dict_Trace_pauli16['Time Series: ' + key] = vPauli
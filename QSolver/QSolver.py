@@ -18,6 +18,9 @@ class Driver(InstrumentDriver.InstrumentWorker):
 		"""Perform the operation of opening the instrument connection"""
 		# init variables
 		self.multiqubit = MultiQubitHamiltonian()
+		# flags for results that need to be re-calculated after config change
+		self.bSimValid = False
+		self.bSweepValid = False
 		# self.vPolarization = np.zeros((4,))
 		# self.lTrace = [np.array([], dtype=float) for n in range(4)]
 
@@ -34,23 +37,37 @@ class Driver(InstrumentDriver.InstrumentWorker):
 		# dElevels = {'Eigenenergies unlabel': 0, 'Eigenenergies label': 1}
 		# dPolarization = {'Polarization - X': 0, 'Polarization - Y': 1, 'Polarization - Z': 2, '3rd Level Population': 3}
 		# check type of quantity
+		if self.isConfigUpdated():
+			self.bSimValid = False
+			self.bSweepValid = False
 		if quant.name in list({'Eigenenergies unlabel'}) + list({'Eigenenergies label'}):
 			# output data, check if simulation needs to be performed
-			if self.isConfigUpdated():
+			if not self.bSimValid:
 				self.performSimulation()
 			# get new value
 			if quant.name == 'Eigenenergies unlabel':
 				value = quant.getTraceDict(self.vals_unlabel_show*1E9, x0=0, dx=1)
 			if quant.name == 'Eigenenergies label':
 				value = quant.getTraceDict(self.vals_label_show*1E9, x0=0, dx=1)
+		elif quant.name.startswith('Flux Sweep Level '):
+			# all labelled levels are found in one sweep
+			if not self.bSweepValid:
+				self.performSweep()
+			index = int(quant.name.split()[-1]) - 1
+			if index < self.mSweep.shape[1]:
+				vLevel = self.mSweep[:, index]
+			else:
+				vLevel = np.zeros(self.mSweep.shape[0])
+			dx = self.vSweepFlux[1] - self.vSweepFlux[0] if len(self.vSweepFlux) > 1 else 1
+			value = quant.getTraceDict(vLevel*1E9, x0=self.vSweepFlux[0], dx=dx)
 		else:
 			# otherwise, just return current value
 			value = quant.getValue()
 		return value
 
 
-	def performSimulation(self):
-		"""Perform simulation"""
+	def updateConfig(self):
+		"""Update Hamiltonian parameters and labels from driver config"""
 		# get config values
 		Config = dict(
 					nQubit = int(self.getValue('Number of Qubits')),
@@ -91,22 +108,51 @@ class Driver(InstrumentDriver.InstrumentWorker):
 		if self.multiqubit.nQubit == 1:
 			self.multiqubit.generateLabel_1Q()
 			self.multiqubit.list_label_select = ['0','1','2','3']
-			self.multiqubit.generateHamiltonian_1Q_cap()
 		if self.multiqubit.nQubit == 2:
 			self.multiqubit.generateLabel_2Q()
 			self.multiqubit.list_label_select = ['00','10','01','11','20','02']
-			self.multiqubit.generateHamiltonian_2Q_cap()
 		elif self.multiqubit.nQubit == 3:
 			self.multiqubit.generateLabel_3Q()
 			self.multiqubit.list_label_select = ['000','100','010','001','110','101','011','200','020','002']
-			self.multiqubit.generateHamiltonian_3Q_cap()
 		# log.info(str(self.multiqubit.dC1))
-		#
+
+
+	def getNumberOfEigenvalues(self):
+		"""Number of levels to find, sparse solver only finds lowest levels,
+		with margin for the labelled levels"""
+		if self.getValue('Eigensolver') == 'Sparse (lowest levels)':
+			return 2 * len(self.multiqubit.list_label_select)
+		return None
+
+
+	def performSimulation(self):
+		"""Perform simulation"""
+		self.updateConfig()
+		if self.multiqubit.nQubit == 1:
+			self.multiqubit.generateHamiltonian_1Q_cap()
+		elif self.multiqubit.nQubit == 2:
+			self.multiqubit.generateHamiltonian_2Q_cap()
+		elif self.multiqubit.nQubit == 3:
+			self.multiqubit.generateHamiltonian_3Q_cap()
 		# find eigensolution of system Hamiltonian
-		self.multiqubit.vals_unlabel, self.multiqubit.vecs_unlabel = eigensolve(self.multiqubit.H_sys)
+		nEig = self.getNumberOfEigenvalues()
+		self.multiqubit.vals_unlabel, self.multiqubit.vecs_unlabel = eigensolve(self.multiqubit.H_sys, nEig)
 		self.multiqubit.vals_label, self.multiqubit.vecs_label = level_identify(self.multiqubit.vals_unlabel, self.multiqubit.vecs_unlabel, self.multiqubit.list_label_table, self.multiqubit.list_label_select)
 		self.vals_unlabel_show = self.multiqubit.vals_unlabel
 		self.vals_label_show = self.multiqubit.vals_label
+		self.bSimValid = True
+
+
+	def performSweep(self):
+		"""Perform flux sweep of labelled levels"""
+		self.updateConfig()
+		sQubit = self.getValue('Sweep Qubit')
+		self.vSweepFlux = np.linspace(self.getValue('Sweep Flux Start'),
+			self.getValue('Sweep Flux Stop'), int(self.getValue('Sweep Points')))
+		bAdiabatic = self.getValue('Sweep Level Tracking') == 'Eigenvector overlap'
+		self.mSweep = self.multiqubit.sweepFlux(sQubit, self.vSweepFlux,
+			self.getNumberOfEigenvalues(), int(self.getValue('Sweep Worker Processes')), bAdiabatic)
+		self.bSweepValid = True
 
 
 if __name__ == '__main__':
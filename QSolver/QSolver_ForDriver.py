@@ -6,8 +6,13 @@ Created on Wed Jan 24 2018
 """
 
 import numpy as np
-from scipy.linalg import eig
+import scipy.sparse as sp
+from scipy.linalg import eig, eigh
+from scipy.sparse.linalg import eigsh
+from scipy.optimize import linear_sum_assignment
+import multiprocessing
 from qutip import *
+from labber_qubit_operators import generateBasicOperator, generateTensorOperator, generateLabelTable
 
 import logging
 log = logging.getLogger('LabberDriver')
@@ -52,12 +57,29 @@ def T(A, U, *args, **kwargs):
 def Qflatten(Q):
 	return Qobj(Q.full())
 
-def eigensolve(H):
-	# find eigensolution of H
-	H = H.full()
-	vals, vecs = eig(H)    
+def sparse_matrix(H):
+	# Hamiltonian as scipy sparse matrix
+	if isinstance(H, Qobj):
+		H = H.data
+		if not sp.issparse(H):
+			# QuTiP 5 data layer
+			H = H.as_scipy() if hasattr(H, 'as_scipy') else H.to_array()
+	return sp.csr_matrix(H)
+
+def eigensolve(H, nEig=None):
+	# find eigensolution of H, ascending order.  If nEig is given, only the
+	# lowest nEig eigenpairs are found with a sparse solver
+	Hs = sparse_matrix(H)
+	# use Hermitian solvers if possible
+	bHermitian = Hs.nnz == 0 or abs(Hs - Hs.conj().T).max() <= 1E-12 * abs(Hs).max()
+	if bHermitian and nEig is not None and nEig < Hs.shape[0] - 1:
+		vals, vecs = eigsh(Hs, k=nEig, which='SA')
+	elif bHermitian:
+		vals, vecs = eigh(Hs.toarray())
+	else:
+		vals, vecs = eig(Hs.toarray())
 	#idx = vals.argsort()[::-1] #Descending Order
-	idx = vals.argsort() #Ascending Order
+	idx = np.real(vals).argsort() #Ascending Order
 	vals = vals[idx]
 	vecs = vecs[:,idx]
 	return np.real(vals), vecs
@@ -76,6 +98,21 @@ def level_identify(vals, vecs, list_table, list_select):
 				break			
 	return vals[v_idx], vecs[:,v_idx]
 
+def level_continue(vals, vecs, vecs_prev):
+	# identify levels from overlap with eigenvectors of a nearby solution,
+	# assigning each previous level to the new eigenvector with max overlap
+	mOverlap = np.abs(np.dot(vecs_prev.conj().T, vecs))
+	v_row, v_idx = linear_sum_assignment(-mOverlap)
+	v_idx = v_idx[np.argsort(v_row)]
+	return vals[v_idx], vecs[:,v_idx]
+
+def _sweepWorker(args):
+	# eigen solutions for a range of flux points, in a worker process
+	(dCfg, sQubit, vFlux, nEig) = args
+	multiqubit = MultiQubitHamiltonian()
+	multiqubit.__dict__.update(dCfg)
+	return multiqubit.solveFlux(sQubit, vFlux, nEig)
+
 
 
 class MultiQubitHamiltonian():
@@ -161,64 +198,63 @@ class MultiQubitHamiltonian():
 
 	def generateOperators(self):
 		# generate basic operators. matrix truncated at nTrunc 
-		I = qeye(self.nTrunc)
-		a = destroy(self.nTrunc)
-		x = a + a.dag()
-		p = -1j*(a - a.dag())
-		aa = a.dag() * a
-		aaaa = a.dag() * a.dag() * a * a
-		return {'I':I, 'a':a, 'x':x, 'p':p, 'aa':aa, 'aaaa':aaaa}
+		return generateBasicOperator(self.nTrunc)
 
 
 	def generateSubHamiltonian_1Q(self):
 		# generate partial Hamiltonian in 3-qubit system
-		OP = self.generateOperators()
 		# self Hamiltonian operators
-		self.H_Q1_aa = Qflatten(tensor(OP['aa']))
-		self.H_Q1_aaaa = Qflatten(tensor(OP['aaaa']))
+		self.H_Q1_aa = generateTensorOperator(self.nTrunc, 'aa')
+		self.H_Q1_aaaa = generateTensorOperator(self.nTrunc, 'aaaa')
 		# drive Hamiltonian operators
-		self.H_dr_Q1_x = Qflatten(tensor(OP['x']))
-		self.H_dr_Q1_p = Qflatten(tensor(OP['p']))
+		self.H_dr_Q1_x = generateTensorOperator(self.nTrunc, 'x')
+		self.H_dr_Q1_p = generateTensorOperator(self.nTrunc, 'p')
 
 
 	def generateHamiltonian_1Q_cap(self):
 		# construct 3-qubit Hamiltonian
 		self.generateSubHamiltonian_1Q()
+		self.assembleHamiltonian_1Q_cap()
+
+
+	def assembleHamiltonian_1Q_cap(self):
+		# construct Hamiltonian from existing sub-Hamiltonians
 		# self Hamiltonian
 		self.H_Q1 = self.dFreq_Q1 * self.H_Q1_aa + self.dAnh_Q1/2 * self.H_Q1_aaaa
 		# system Hamiltonian
-		self.H_sys = self.H_Q1 + self.H_Q2 + self.H_12
+		self.H_sys = self.H_Q1
 
 
 	def generateLabel_1Q(self):
-		# generate 3-qubit number state label list
-		list_label_gen = ["0","1","2","3","4","5","6","7"]
-		self.list_label_table = []
-		for k1 in np.arange(self.nTrunc):
-			self.list_label_table.append(list_label_gen[k1])
+		# generate 1-qubit number state label list
+		self.list_label_table = list(generateLabelTable(1, self.nTrunc))
 
 
 	def generateSubHamiltonian_2Q(self):
 		# generate partial Hamiltonian in 3-qubit system
-		OP = self.generateOperators()
 		# self Hamiltonian operators
-		self.H_Q1_aa = Qflatten(tensor(OP['aa'], OP['I']))
-		self.H_Q1_aaaa = Qflatten(tensor(OP['aaaa'], OP['I']))
-		self.H_Q2_aa = Qflatten(tensor(OP['I'], OP['aa']))
-		self.H_Q2_aaaa = Qflatten(tensor(OP['I'], OP['aaaa']))
+		self.H_Q1_aa = generateTensorOperator(self.nTrunc, 'aa', 'I')
+		self.H_Q1_aaaa = generateTensorOperator(self.nTrunc, 'aaaa', 'I')
+		self.H_Q2_aa = generateTensorOperator(self.nTrunc, 'I', 'aa')
+		self.H_Q2_aaaa = generateTensorOperator(self.nTrunc, 'I', 'aaaa')
 		# coupling Hamiltonian operators
-		self.H_12_xx = Qflatten(tensor(OP['x'], OP['x']))#
-		self.H_12_pp = Qflatten(tensor(OP['p'], OP['p']))
+		self.H_12_xx = generateTensorOperator(self.nTrunc, 'x', 'x')
+		self.H_12_pp = generateTensorOperator(self.nTrunc, 'p', 'p')
 		# drive Hamiltonian operators
-		self.H_dr_Q1_x = Qflatten(tensor(OP['x'], OP['I']))
-		self.H_dr_Q2_x = Qflatten(tensor(OP['I'], OP['x']))
-		self.H_dr_Q1_p = Qflatten(tensor(OP['p'], OP['I']))
-		self.H_dr_Q2_p = Qflatten(tensor(OP['I'], OP['p']))
+		self.H_dr_Q1_x = generateTensorOperator(self.nTrunc, 'x', 'I')
+		self.H_dr_Q2_x = generateTensorOperator(self.nTrunc, 'I', 'x')
+		self.H_dr_Q1_p = generateTensorOperator(self.nTrunc, 'p', 'I')
+		self.H_dr_Q2_p = generateTensorOperator(self.nTrunc, 'I', 'p')
 
 
 	def generateHamiltonian_2Q_cap(self):
 		# construct 3-qubit Hamiltonian
 		self.generateSubHamiltonian_2Q()
+		self.assembleHamiltonian_2Q_cap()
+
+
+	def assembleHamiltonian_2Q_cap(self):
+		# construct Hamiltonian from existing sub-Hamiltonians
 		# self Hamiltonian
 		self.H_Q1 = self.dFreq_Q1 * self.H_Q1_aa + self.dAnh_Q1/2 * self.H_Q1_aaaa
 		self.H_Q2 = self.dFreq_Q2 * self.H_Q2_aa + self.dAnh_Q2/2 * self.H_Q2_aaaa
@@ -230,43 +266,43 @@ class MultiQubitHamiltonian():
 
 
 	def generateLabel_2Q(self):
-		# generate 3-qubit number state label list
-		list_label_gen = ["0","1","2","3","4","5","6","7"]
-		self.list_label_table = []
-		for k1 in np.arange(self.nTrunc):
-			for k2 in np.arange(self.nTrunc):
-				self.list_label_table.append(list_label_gen[k1] + list_label_gen[k2])
+		# generate 2-qubit number state label list
+		self.list_label_table = list(generateLabelTable(2, self.nTrunc))
 
 
 	def generateSubHamiltonian_3Q(self):
 		# generate partial Hamiltonian in 3-qubit system
-		OP = self.generateOperators()
 		# self Hamiltonian operators
-		self.H_Q1_aa = Qflatten(tensor(OP['aa'], OP['I'], OP['I']))
-		self.H_Q1_aaaa = Qflatten(tensor(OP['aaaa'], OP['I'], OP['I']))
-		self.H_Q2_aa = Qflatten(tensor(OP['I'], OP['aa'], OP['I']))
-		self.H_Q2_aaaa = Qflatten(tensor(OP['I'], OP['aaaa'], OP['I']))
-		self.H_Q3_aa = Qflatten(tensor(OP['I'], OP['I'], OP['aa']))
-		self.H_Q3_aaaa = Qflatten(tensor(OP['I'], OP['I'], OP['aaaa']))
+		self.H_Q1_aa = generateTensorOperator(self.nTrunc, 'aa', 'I', 'I')
+		self.H_Q1_aaaa = generateTensorOperator(self.nTrunc, 'aaaa', 'I', 'I')
+		self.H_Q2_aa = generateTensorOperator(self.nTrunc, 'I', 'aa', 'I')
+		self.H_Q2_aaaa = generateTensorOperator(self.nTrunc, 'I', 'aaaa', 'I')
+		self.H_Q3_aa = generateTensorOperator(self.nTrunc, 'I', 'I', 'aa')
+		self.H_Q3_aaaa = generateTensorOperator(self.nTrunc, 'I', 'I', 'aaaa')
 		# coupling Hamiltonian operators
-		self.H_12_xx = Qflatten(tensor(OP['x'], OP['x'], OP['I']))
-		self.H_23_xx = Qflatten(tensor(OP['I'], OP['x'], OP['x']))
-		self.H_13_xx = Qflatten(tensor(OP['x'], OP['I'], OP['x']))		#
-		self.H_12_pp = Qflatten(tensor(OP['p'], OP['p'], OP['I']))
-		self.H_23_pp = Qflatten(tensor(OP['I'], OP['p'], OP['p']))
-		self.H_13_pp = Qflatten(tensor(OP['p'], OP['I'], OP['p']))
+		self.H_12_xx = generateTensorOperator(self.nTrunc, 'x', 'x', 'I')
+		self.H_23_xx = generateTensorOperator(self.nTrunc, 'I', 'x', 'x')
+		self.H_13_xx = generateTensorOperator(self.nTrunc, 'x', 'I', 'x')		#
+		self.H_12_pp = generateTensorOperator(self.nTrunc, 'p', 'p', 'I')
+		self.H_23_pp = generateTensorOperator(self.nTrunc, 'I', 'p', 'p')
+		self.H_13_pp = generateTensorOperator(self.nTrunc, 'p', 'I', 'p')
 		# drive Hamiltonian operators
-		self.H_dr_Q1_x = Qflatten(tensor(OP['x'], OP['I'], OP['I']))
-		self.H_dr_Q2_x = Qflatten(tensor(OP['I'], OP['x'], OP['I']))
-		self.H_dr_Q3_x = Qflatten(tensor(OP['I'], OP['I'], OP['x']))
-		self.H_dr_Q1_p = Qflatten(tensor(OP['p'], OP['I'], OP['I']))
-		self.H_dr_Q2_p = Qflatten(tensor(OP['I'], OP['p'], OP['I']))
-		self.H_dr_Q3_p = Qflatten(tensor(OP['I'], OP['I'], OP['p']))
+		self.H_dr_Q1_x = generateTensorOperator(self.nTrunc, 'x', 'I', 'I')
+		self.H_dr_Q2_x = generateTensorOperator(self.nTrunc, 'I', 'x', 'I')
+		self.H_dr_Q3_x = generateTensorOperator(self.nTrunc, 'I', 'I', 'x')
+		self.H_dr_Q1_p = generateTensorOperator(self.nTrunc, 'p', 'I', 'I')
+		self.H_dr_Q2_p = generateTensorOperator(self.nTrunc, 'I', 'p', 'I')
+		self.H_dr_Q3_p = generateTensorOperator(self.nTrunc, 'I', 'I', 'p')
 
 
 	def generateHamiltonian_3Q_cap(self):
 		# construct 3-qubit Hamiltonian
 		self.generateSubHamiltonian_3Q()
+		self.assembleHamiltonian_3Q_cap()
+
+
+	def assembleHamiltonian_3Q_cap(self):
+		# construct Hamiltonian from existing sub-Hamiltonians
 		# self Hamiltonian
 		self.H_Q1 = self.dFreq_Q1 * self.H_Q1_aa + self.dAnh_Q1/2 * self.H_Q1_aaaa
 		self.H_Q2 = self.dFreq_Q2 * self.H_Q2_aa + self.dAnh_Q2/2 * self.H_Q2_aaaa
@@ -284,10 +320,62 @@ class MultiQubitHamiltonian():
 
 	def generateLabel_3Q(self):
 		# generate 3-qubit number state label list
-		list_label_gen = ["0","1","2","3","4","5","6","7"]
-		self.list_label_table = []
-		for k1 in np.arange(self.nTrunc):
-			for k2 in np.arange(self.nTrunc):
-				for k3 in np.arange(self.nTrunc):
-					self.list_label_table.append(list_label_gen[k1] + list_label_gen[k2] + list_label_gen[k3])
-
+		self.list_label_table = list(generateLabelTable(3, self.nTrunc))
+
+
+	def solveFlux(self, sQubit, vFlux, nEig=None):
+		# unlabelled eigen solutions for an array of flux biases of one qubit.
+		# Sub-Hamiltonians are built once and only re-weighted per flux point
+		getattr(self, 'generateSubHamiltonian_%dQ' % self.nQubit)()
+		assemble = getattr(self, 'assembleHamiltonian_%dQ_cap' % self.nQubit)
+		dFlux0 = getattr(self, 'dFlux_' + sQubit)
+		lSolution = []
+		try:
+			for dFlux in vFlux:
+				# update frequencies from flux, then rebuild Hamiltonian
+				self.updateSimCfg({'dFlux_' + sQubit: dFlux})
+				if not getattr(self, 'dFreq_' + sQubit) > 0:
+					raise ValueError('Non-positive frequency of %s at flux bias %g' % (sQubit, dFlux))
+				assemble()
+				lSolution.append(eigensolve(self.H_sys, nEig))
+		finally:
+			# restore flux bias and Hamiltonian
+			self.updateSimCfg({'dFlux_' + sQubit: dFlux0})
+			assemble()
+		return lSolution
+
+
+	def sweepFlux(self, sQubit, vFlux, nEig=None, nWorker=1, bAdiabatic=True):
+		# labelled eigenenergies for an array of flux biases of one qubit,
+		# for qubits using the design parameter set.  Levels are labelled at
+		# the first point with level_identify, and then either tracked between
+		# neighbouring flux points from eigenvector overlaps (adiabatic), or
+		# labelled again at each point (diabatic).  Returns array (n_flux, n_label)
+		if not (getattr(self, 'bDesignParam_' + sQubit) and getattr(self, 'sQubitType_' + sQubit) == '2-JJ'):
+			raise ValueError('Flux sweep of %s requires design parameters of a 2-JJ qubit' % sQubit)
+		vFlux = np.asarray(vFlux, dtype=float)
+		nWorker = min(max(int(nWorker), 1), len(vFlux))
+		if nWorker > 1:
+			# eigen solutions for ranges of flux points, one per worker
+			dCfg = {key: value for key, value in self.__dict__.items()
+					if not isinstance(value, (Qobj, np.ndarray))}
+			lArgs = [(dCfg, sQubit, v, nEig) for v in np.array_split(vFlux, nWorker)]
+			pool = multiprocessing.Pool(nWorker)
+			try:
+				lSolution = [sol for lSol in pool.map(_sweepWorker, lArgs) for sol in lSol]
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			lSolution = self.solveFlux(sQubit, vFlux, nEig)
+		# labelling is done in sequence over all points, so the result does
+		# not depend on the number of workers
+		mVals = np.zeros((len(vFlux), len(self.list_label_select)))
+		vecs_label = None
+		for n, (vals, vecs) in enumerate(lSolution):
+			if bAdiabatic and vecs_label is not None:
+				vals_label, vecs_label = level_continue(vals, vecs, vecs_label)
+			else:
+				vals_label, vecs_label = level_identify(vals, vecs, self.list_label_table, self.list_label_select)
+			mVals[n] = vals_label
+		return mVals
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Cached operators and label tables for multi-transmon Hamiltonians, shared by
+the QSolver and QEvolver_3Q drivers.  Drivers in other folders add this
+folder to the python path before importing the module.
+"""
+
+import functools
+import itertools
+from qutip import Qobj, qeye, destroy, tensor
+
+
+@functools.lru_cache(maxsize=None)
+def generateBasicOperator(nTrunc):
+	# generate basic operators. matrix truncated at nTrunc.  Cached, the
+	# operators must not be modified by the caller
+	I = qeye(nTrunc)
+	a = destroy(nTrunc)
+	x = a + a.dag()
+	p = -1j*(a - a.dag())
+	aa = a.dag() * a
+	aaaa = a.dag() * a.dag() * a * a
+	return {'I':I, 'a':a, 'x':x, 'p':p, 'aa':aa, 'aaaa':aaaa}
+
+@functools.lru_cache(maxsize=None)
+def generateTensorOperator(nTrunc, *lOp):
+	# flattened tensor product of basic operators, one name per qubit, e.g.
+	# ('aa', 'I', 'I').  Cached, must not be modified by the caller
+	OP = generateBasicOperator(nTrunc)
+	return Qobj(tensor([OP[sOp] for sOp in lOp]).full())
+
+@functools.lru_cache(maxsize=None)
+def generateLabelTable(nQubit, nTrunc):
+	# number state labels of all basis states, e.g. '010'
+	return tuple(''.join(t) for t in itertools.product([str(n) for n in range(nTrunc)], repeat=nQubit))
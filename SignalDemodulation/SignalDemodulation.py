@@ -2,6 +2,9 @@
 
 import InstrumentDriver
 import numpy as np
+from scipy.signal import resample_poly
+
+import labber_demodulation_kernels as demodulation
 
 
 class Error(Exception):
@@ -10,9 +13,15 @@ class Error(Exception):
 class Driver(InstrumentDriver.InstrumentWorker):
     """ This class implements a demodulation driver"""
 
+    # max number of segments demodulated at once, to bound memory usage
+    BLOCK_SIZE = 4096
+
     def performOpen(self, options={}):
         """Perform the operation of opening the instrument connection"""
-        pass
+        # cached demodulation result, as (input traces, settings, signal)
+        self.demodCache = None
+        # training traces for matched-filter weights, for state 0 and 1
+        self.lTraining = [None, None]
 
 
     def performClose(self, bError=False, options={}):
@@ -23,7 +32,11 @@ class Driver(InstrumentDriver.InstrumentWorker):
     def performSetValue(self, quant, value, sweepRate=0.0, options={}):
         """Perform the Set Value instrument operation. This function should
         return the actual value set by the instrument"""
-        # do nothing here
+        # store training data for matched-filter integration weights
+        if (quant.name == 'Input data' and
+                self.getValue('Perform weight training')):
+            quant.setValue(value)
+            self.addTrainingTrace(self.getValue('Input data'))
         return value
 
 
@@ -31,31 +44,100 @@ class Driver(InstrumentDriver.InstrumentWorker):
         """Perform the Get Value instrument operation"""
         if quant.name == 'Value':
             # calculate I/Q signal here
-            value = np.mean(self.getIQAmplitudes())
+            value = np.mean(self.getIQAmplitudesAll()[0])
         elif quant.name == 'Value - Single shot':
             # calculate I/Q signal here
-            value = self.getIQAmplitudes()
+            value = self.getIQAmplitudesAll()[0]
         elif quant.name.startswith('Value #'):
+            # all frequencies are demodulated in one pass, and cached
             index = int(quant.name[-1])
-            sDemodFreq = 'Mod. frequency #' + str(index)
-            dFreq = self.getValue(sDemodFreq)
-            value = np.mean(self.getIQAmplitudes_MultiFreq(dFreq))
+            value = np.mean(self.getIQAmplitudesAll()[index - 1])
+        elif quant.name == 'Value - Decimated trace':
+            # time-resolved I/Q trace, averaged over segments
+            (vTrace, dtOut, t0) = self.getDecimatedTrace()
+            value = quant.getTraceDict(vTrace, t0=t0, dt=dtOut)
         else:
             # just return the quantity value
             value = quant.getValue()
         return value
 
+    def getModulationFrequencies(self):
+        """Return list with modulation frequency and mod. frequencies #2-#9"""
+        lFreq = [self.getValue('Modulation frequency')]
+        for n in range(2, 10):
+            lFreq.append(self.getValue('Mod. frequency #%d' % n))
+        return lFreq
+
+    def addTrainingTrace(self, traceIn):
+        """Store mean and noise variance of input traces, as training data
+        for the state given by 'Training, input state'"""
+        if traceIn is None:
+            return
+        vY = traceIn['y']
+        dt = traceIn['dt']
+        nSegment = int(self.getValue('Number of segments'))
+        shape = traceIn.get('shape', vY.shape)
+        if len(shape) > 1:
+            nSegment = shape[0]
+        if dt==0:
+            dt = 1.0
+        vData = np.reshape(vY, (nSegment, int(vY.size/nSegment)))
+        nState = int(self.getValue('Training, input state'))
+        self.lTraining[nState] = demodulation.get_training_trace(vData, dt)
+        # weights have changed, cached result is no longer valid
+        self.demodCache = None
+
+    def getTraining(self):
+        """Return training traces for matched-filter weights, or None if
+        using box integration"""
+        if (self.getValue('Integration weights') != 'Matched filter' or
+                None in self.lTraining):
+            return None
+        return tuple(self.lTraining)
+
     def getIQAmplitudes(self):
         """Calculate complex signal from data and reference"""
+        return self.getIQAmplitudesAll()[0]
+
+    def getIQAmplitudes_MultiFreq(self, dFreq):
+        """Calculate complex signal from data and reference"""
+        return self.demodulate([dFreq])[0]
+
+    def getIQAmplitudesAll(self):
+        """Calculate complex signal for all modulation frequencies, in one pass.
+        The result is cached and re-used until input data or settings change"""
+        lFreq = self.getModulationFrequencies()
+        traceIn = self.getValue('Input data')
+        traceRef = self.getValue('Reference data')
+        # cache key, input traces are compared by identity
+        lTrace = [None if traceIn is None else traceIn['y'],
+                  None if traceRef is None else traceRef['y']]
+        cfg = (tuple(lFreq), self.getValue('Skip start'),
+               self.getValue('Length'), self.getValue('Number of segments'),
+               self.getValue('Use phase reference signal'),
+               self.getValue('Use single precision'),
+               self.getValue('Integration weights'))
+        if (self.demodCache is not None and self.demodCache[1] == cfg and
+                all(x is y for (x, y) in zip(self.demodCache[0], lTrace))):
+            return self.demodCache[2]
+        lSignal = self.demodulate(lFreq)
+        # keep references to input arrays, to make identity check valid
+        self.demodCache = (lTrace, cfg, lSignal)
+        return lSignal
+
+    def demodulate(self, lFreq):
+        """Calculate complex signal from data and reference, for a list of
+        modulation frequencies.  All frequencies, and the reference, are
+        integrated in a single matrix product over the input data"""
+        nFreq = len(lFreq)
         # get parameters
-        dFreq = self.getValue('Modulation frequency')
         skipStart = self.getValue('Skip start')
         nSegment = int(self.getValue('Number of segments'))
         # get input data from dict, with keys {'y': value, 't0': t0, 'dt': dt}
         traceIn = self.getValue('Input data')
         if traceIn is None:
-            return complex(0.0)
-        vY = traceIn['y']     
+            return [complex(0.0)] * nFreq
+        vY = traceIn['y']
         dt = traceIn['dt']
         # get shape of input data
         shape = traceIn.get('shape', vY.shape)
@@ -65,86 +147,106 @@ class Driver(InstrumentDriver.InstrumentWorker):
         # avoid exceptions if no time step is given
         if dt==0:
             dt = 1.0
-        skipIndex = int(round(skipStart/dt))
         nTotLength = vY.size
-        length = 1 + int(round(self.getValue('Length')/dt))
-        length = min(length, int(nTotLength/nSegment)-skipIndex)
-        if length <=1:
-            return complex(0.0)
         bUseRef = bool(self.getValue('Use phase reference signal'))
+        dtype = np.float32 if self.getValue('Use single precision') else np.float64
         # define data to use, put in 2d array of segments
         vData = np.reshape(vY, (nSegment, int(nTotLength/nSegment)))
-        # calculate cos/sin vectors, allow segmenting
-        vTime = dt * (skipIndex + np.arange(length, dtype=float))
-        vCos = np.cos(2*np.pi * vTime * dFreq)
-        vSin = np.sin(2*np.pi * vTime * dFreq)
-        # calc I/Q
-        dI = 2. * np.trapz(vCos * vData[:,skipIndex:skipIndex+length]) / float(length-1)
-        dQ = 2. * np.trapz(vSin * vData[:,skipIndex:skipIndex+length]) / float(length-1)
-        signal = dI + 1j*dQ
+        vRef = None
         if bUseRef:
             traceRef = self.getValue('Reference data')
             # skip reference if trace length doesn't match
-            if len(traceRef['y']) != len(vY):
-                return signal
-            vRef = np.reshape(traceRef['y'], (nSegment, int(nTotLength/nSegment)))
-            dIref = 2. * np.trapz(vCos * vRef[:,skipIndex:skipIndex+length]) / float(length-1)
-            dQref = 2. * np.trapz(vSin * vRef[:,skipIndex:skipIndex+length]) / float(length-1)
-            # subtract the reference angle
-            dAngleRef = np.arctan2(dQref, dIref)
-            signal /= (np.cos(dAngleRef) + 1j*np.sin(dAngleRef))
-        return signal
-    
-
-
-    def getIQAmplitudes_MultiFreq(self,dFreq):
-        """Calculate complex signal from data and reference"""
-        # get parameters
-        skipStart = self.getValue('Skip start')
+            if len(traceRef['y']) == len(vY):
+                vRef = np.reshape(traceRef['y'], vData.shape)
+        # calc I/Q for all frequencies, in one matrix product
+        mSignal = demodulation.demodulate(
+            vData, dt, lFreq, skipStart, self.getValue('Length'), vRef,
+            dtype=dtype, block_size=self.BLOCK_SIZE,
+            training=self.getTraining())
+        if mSignal is None:
+            return [complex(0.0)] * nFreq
+        return [mSignal[:,n] for n in range(nFreq)]
+
+    def getDecimatedTrace(self):
+        """Calculate time-resolved I/Q trace by digital downconversion of the
+        input data at the modulation frequency, averaged over all segments.
+        Returns the trace, its time step and start time"""
+        dFreq = self.getValue('Modulation frequency')
+        nDecimation = max(int(self.getValue('Decimation factor')), 1)
+        sFilter = self.getValue('Decimation filter')
+        nOrder = int(self.getValue('CIC order'))
         nSegment = int(self.getValue('Number of segments'))
-        # get input data from dict, with keys {'y': value, 't0': t0, 'dt': dt}
         traceIn = self.getValue('Input data')
         if traceIn is None:
-            return complex(0.0)
-        vY = traceIn['y']     
+            return (np.zeros(0, dtype=complex), 1.0, 0.0)
+        vY = traceIn['y']
         dt = traceIn['dt']
-        # get shape of input data
+        t0 = traceIn.get('t0', 0.0)
         shape = traceIn.get('shape', vY.shape)
-        # override segment parameter if input data has more than one dimension
         if len(shape) > 1:
             nSegment = shape[0]
-        # avoid exceptions if no time step is given
         if dt==0:
             dt = 1.0
-        skipIndex = int(round(skipStart/dt))
         nTotLength = vY.size
-        length = 1 + int(round(self.getValue('Length')/dt))
-        length = min(length, int(nTotLength/nSegment)-skipIndex)
-        if length <=1:
-            return complex(0.0)
-        bUseRef = bool(self.getValue('Use phase reference signal'))
-        # define data to use, put in 2d array of segments
         vData = np.reshape(vY, (nSegment, int(nTotLength/nSegment)))
-        # calculate cos/sin vectors, allow segmenting
-        vTime = dt * (skipIndex + np.arange(length, dtype=float))
-        vCos = np.cos(2*np.pi * vTime * dFreq)
-        vSin = np.sin(2*np.pi * vTime * dFreq)
-        # calc I/Q
-        dI = 2. * np.trapz(vCos * vData[:,skipIndex:skipIndex+length]) / float(length-1)
-        dQ = 2. * np.trapz(vSin * vData[:,skipIndex:skipIndex+length]) / float(length-1)
-        signal = dI + 1j*dQ
-        if bUseRef:
+        # phase reference, from reference data integrated over demod window
+        vRefAngle = None
+        if bool(self.getValue('Use phase reference signal')):
             traceRef = self.getValue('Reference data')
-            # skip reference if trace length doesn't match
-            if len(traceRef['y']) != len(vY):
-                return signal
-            vRef = np.reshape(traceRef['y'], (nSegment, int(nTotLength/nSegment)))
-            dIref = 2. * np.trapz(vCos * vRef[:,skipIndex:skipIndex+length]) / float(length-1)
-            dQref = 2. * np.trapz(vSin * vRef[:,skipIndex:skipIndex+length]) / float(length-1)
-            # subtract the reference angle
-            dAngleRef = np.arctan2(dQref, dIref)
-            signal /= (np.cos(dAngleRef) + 1j*np.sin(dAngleRef))
-        return signal
+            if len(traceRef['y']) == len(vY):
+                vRef = np.reshape(traceRef['y'], vData.shape)
+                mIQref = demodulation.demodulate(
+                    vRef, dt, [dFreq], self.getValue('Skip start'),
+                    self.getValue('Length'), block_size=self.BLOCK_SIZE)
+                if mIQref is not None:
+                    vRefAngle = np.angle(mIQref[:,0])
+        # downconvert in blocks of segments, accumulate average
+        vTrace = None
+        for n in range(0, nSegment, self.BLOCK_SIZE):
+            mIQ = downconvert(vData[n:n+self.BLOCK_SIZE], dt, dFreq,
+                              nDecimation, sFilter, nOrder)
+            if vRefAngle is not None:
+                mIQ *= np.exp(-1j*vRefAngle[n:n+self.BLOCK_SIZE])[:,None]
+            if vTrace is None:
+                vTrace = mIQ.sum(0)
+            else:
+                vTrace += mIQ.sum(0)
+        return (vTrace / nSegment, dt * nDecimation, t0)
+
+
+def downconvert(mData, dt, dFreq, nDecimation, sFilter='Polyphase FIR',
+                nOrder=3):
+    """Digital downconversion of a 2D block of records.
+
+    The records are mixed down with a numerically controlled oscillator at
+    the modulation frequency, low-pass filtered and decimated by an integer
+    factor.  The filter is either a polyphase FIR filter, or a CIC filter of
+    the given order.  The I/Q convention and scaling match the integrated
+    values from the demodulation, so that the mean of the downconverted
+    trace over the demodulation window equals the demodulated value.
+
+    Returns complex array with shape (n_records, n_samples // nDecimation)"""
+    mData = np.atleast_2d(mData)
+    nSample = mData.shape[1]
+    # NCO mixing
+    vNCO = 2*np.exp(2j*np.pi*dFreq*dt*np.arange(nSample))
+    mMixed = mData * vNCO
+    if nDecimation <= 1:
+        return mMixed
+    nOut = nSample // nDecimation
+    if sFilter == 'CIC':
+        # cascaded moving averages of length nDecimation, then decimate
+        for n in range(max(nOrder, 1) - 1):
+            mCum = np.cumsum(mMixed, axis=1)
+            mMixed[:,nDecimation:] = mCum[:,nDecimation:] - mCum[:,:-nDecimation]
+            mMixed[:,:nDecimation] = mCum[:,:nDecimation]
+            mMixed /= nDecimation
+        # last stage is integrate-and-dump over each output sample
+        return mMixed[:,:nOut*nDecimation].reshape(
+            (-1, nOut, nDecimation)).mean(axis=2)
+    else:
+        # polyphase FIR low-pass and decimation
+        return resample_poly(mMixed, 1, nDecimation, axis=1)[:,:nOut]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""Shared kernels for I/Q demodulation of digitizer traces.
+
+The functions in this module are used by the SignalDemodulation, Acqiris and
+MultiQubit_PulseGenerator drivers.  Drivers in other folders add this folder
+to the python path before importing the module, the module name is unique
+to avoid shadowing other modules on the path.
+
+Demodulation is done by integrating the data against precomputed kernels,
+with the trapezoid weights and normalization folded in.  The integration is
+a matrix product, done in blocks of segments with preallocated buffers so
+that memory usage is bounded.  Optional matched-filter weights, estimated
+from state 0/1 training traces, are folded into the kernel in the same way.
+
+"""
+import functools
+
+import numpy as np
+
+# max number of segments integrated at once, bounds memory usage
+BLOCK_SIZE = 4096
+
+
+def get_indices(dt, skip, length, n_sample):
+    """Get first index and number of samples of integration window.
+
+    Parameters
+    ----------
+    dt : float
+        Time step of input data
+
+    skip : float
+        Time to skip at start of each record, in seconds
+
+    length : float
+        Length of integration window, in seconds
+
+    n_sample : int
+        Number of samples per record
+
+    Returns
+    -------
+    n0 : int
+        Index of first sample to include
+
+    n_length : int
+        Number of samples to include
+
+    """
+    n0 = int(round(skip / dt))
+    n_length = 1 + int(round(length / dt))
+    n_length = int(min(n_length, n_sample - n0))
+    return (n0, n_length)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_kernel(frequencies, dt, n0, n_length, scale, dtype):
+    vWeight = np.full(n_length, scale / float(n_length - 1))
+    vWeight[0] *= 0.5
+    vWeight[-1] *= 0.5
+    vTime = dt * (n0 + np.arange(n_length, dtype=float))
+    kernel = vWeight[:, np.newaxis] * np.exp(
+        2j * np.pi * np.outer(vTime, frequencies))
+    kernel_real = np.hstack((kernel.real, kernel.imag))
+    kernel = kernel.astype(np.result_type(dtype, np.complex64))
+    kernel_real = kernel_real.astype(dtype)
+    # kernels are shared between callers, protect from modification
+    kernel.flags.writeable = False
+    kernel_real.flags.writeable = False
+    return (kernel, kernel_real)
+
+
+def get_kernel(frequencies, dt, n0, n_length, scale=2.0, dtype=np.float64):
+    """Get demodulation kernel, with trapezoid weights folded in.
+
+    Kernels are cached, keyed by frequencies, time step, first index and
+    length.  The returned arrays are read-only.
+
+    Parameters
+    ----------
+    frequencies : list of float
+        Demodulation frequencies
+
+    dt : float
+        Time step of input data
+
+    n0 : int
+        Index of first sample to include
+
+    n_length : int
+        Number of samples to include
+
+    scale : float
+        Overall scale factor, 2 for real data and 1 for complex I/Q data
+
+    dtype : numpy dtype
+        Real data type of kernel, float64 or float32
+
+    Returns
+    -------
+    kernel : complex numpy array
+        Kernel with shape (n_length, n_freq)
+
+    kernel_real : numpy array
+        Real and imaginary parts of kernel, shape (n_length, 2 * n_freq)
+
+    """
+    return _get_kernel(tuple(float(f) for f in np.atleast_1d(frequencies)),
+                       float(dt), int(n0), int(n_length), float(scale),
+                       np.dtype(dtype))
+
+
+def get_training_trace(data, dt):
+    """Get mean and noise variance of training records.
+
+    Parameters
+    ----------
+    data : numpy array
+        Records as 2D real or complex array, shape (n_segment, n_sample)
+
+    dt : float
+        Time step of input data
+
+    Returns
+    -------
+    training : tuple
+        Tuple (mean, var, dt), var is None if there is only one record
+
+    """
+    # noise variance is only defined if there are multiple segments
+    var = data.var(0) if data.shape[0] > 1 else None
+    return (data.mean(0), var, dt)
+
+
+def get_weights(training_0, training_1, frequencies, dt, n0, n_length):
+    """Get matched-filter integration weights from training traces.
+
+    The weights are given by the complex conjugate of the demodulated
+    state 0/1 difference envelope, divided by the noise variance. The
+    envelope is smoothed over one modulation period to remove the image
+    term, and the weights are rotated to keep the phase of the
+    box-integrated signal. The weights are normalized to unit mean
+    magnitude, so that a flat envelope gives the box window.
+
+    Parameters
+    ----------
+    training_0 : tuple
+        Training trace with qubit in state 0, see get_training_trace
+
+    training_1 : tuple
+        Training trace with qubit in state 1, see get_training_trace
+
+    frequencies : list of float
+        Demodulation frequencies
+
+    dt : float
+        Time step of input data
+
+    n0 : int
+        Index of first sample to include
+
+    n_length : int
+        Number of samples to include
+
+    Returns
+    -------
+    weights : complex numpy array or None
+        Weights with shape (n_length, n_freq), or None if the training
+        traces do not match the input data
+
+    """
+    ((mean_0, var_0, dt_0), (mean_1, var_1, dt_1)) = (training_0, training_1)
+    # training data must match data to demodulate
+    if (dt_0 != dt or dt_1 != dt or len(mean_0) != len(mean_1) or
+            len(mean_0) < n0 + n_length):
+        return None
+    vDiff = (mean_1 - mean_0)[n0:n0 + n_length]
+    if var_0 is not None and var_1 is not None:
+        vVar = 0.5 * (var_0 + var_1)[n0:n0 + n_length]
+    else:
+        vVar = None
+    vTime = dt * (n0 + np.arange(n_length, dtype=float))
+    frequencies = np.atleast_1d(frequencies)
+    weights = np.ones((n_length, len(frequencies)), dtype=complex)
+    for n, frequency in enumerate(frequencies):
+        vEnv = vDiff * np.exp(2j * np.pi * vTime * frequency)
+        # smooth over one period, to remove image and other tones
+        n_period = int(round(1.0 / (abs(frequency) * dt))) \
+            if frequency != 0 else 1
+        n_period = min(max(n_period, 1), n_length)
+        if n_period > 1:
+            vBox = np.ones(n_period) / n_period
+            vEnv = np.convolve(vEnv, vBox, mode='same')
+        vWeight = vEnv.conj() * np.exp(1j * np.angle(np.sum(vEnv)))
+        if vVar is not None and np.all(vVar > 0):
+            if n_period > 1:
+                vWeight /= np.convolve(vVar, vBox, mode='same')
+            else:
+                vWeight /= vVar
+        norm = np.mean(np.abs(vWeight))
+        if norm > 0:
+            weights[:, n] = vWeight / norm
+    return weights
+
+
+def apply_weights(kernel, weights):
+    """Fold integration weights into a demodulation kernel.
+
+    Parameters
+    ----------
+    kernel : complex numpy array
+        Kernel with shape (n_length, n_freq)
+
+    weights : complex numpy array
+        Weights with shape (n_length, n_freq)
+
+    Returns
+    -------
+    kernel : complex numpy array
+        Weighted kernel with shape (n_length, n_freq)
+
+    kernel_real : numpy array
+        Real and imaginary parts of kernel, shape (n_length, 2 * n_freq)
+
+    """
+    kernel = (kernel * weights).astype(kernel.dtype)
+    kernel_real = np.hstack((kernel.real, kernel.imag))
+    return (kernel, kernel_real)
+
+
+def integrate(data, kernel, kernel_real, n0=0, block_size=BLOCK_SIZE):
+    """Integrate 2D segment data against kernel, for all frequencies.
+
+    Parameters
+    ----------
+    data : numpy array or tuple
+        Records as 2D real or complex array, shape (n_segment, n_sample), or
+        tuple of 2D (I, Q) arrays
+
+    kernel : complex numpy array
+        Kernel with shape (n_length, n_freq)
+
+    kernel_real : numpy array
+        Real and imaginary parts of kernel, shape (n_length, 2 * n_freq)
+
+    n0 : int
+        Index of first sample to include
+
+    block_size : int
+        Max number of segments integrated at once
+
+    Returns
+    -------
+    values : complex numpy array
+        Complex array with shape (n_segment, n_freq)
+
+    """
+    return integrate_blocks([data], kernel, kernel_real, n0, block_size)
+
+
+def integrate_blocks(blocks, kernel, kernel_real, n0=0,
+                     block_size=BLOCK_SIZE):
+    """Integrate blocks of segments against kernel, with bounded memory.
+
+    Blocks are processed in chunks of at most block_size segments, using
+    preallocated work buffers.  Real data is integrated against the real
+    kernel to avoid casting to complex, complex data is copied block-wise
+    into a complex buffer.  Data is converted to the kernel data type, so
+    that a float32 kernel gives single-precision BLAS products.
+
+    Parameters
+    ----------
+    blocks : iterable
+        Blocks of records, see integrate
+
+    kernel : complex numpy array
+        Kernel with shape (n_length, n_freq)
+
+    kernel_real : numpy array
+        Real and imaginary parts of kernel, shape (n_length, 2 * n_freq)
+
+    n0 : int
+        Index of first sample to include
+
+    block_size : int
+        Max number of segments integrated at once
+
+    Returns
+    -------
+    values : complex numpy array
+        Complex array with shape (n_segment, n_freq)
+
+    """
+    n_block = max(int(block_size), 1)
+    (n_length, n_freq) = kernel.shape
+    # work buffers, allocated when first needed
+    buffer_data = None
+    buffer_real = None
+    buffer_iq = None
+    buffer_complex = None
+    values = []
+    for block in blocks:
+        if isinstance(block, tuple):
+            (vI, vQ) = block
+        elif np.iscomplexobj(block):
+            (vI, vQ) = (block.real, block.imag)
+        else:
+            (vI, vQ) = (block, None)
+        for k in range(0, vI.shape[0], n_block):
+            vData = vI[k:k + n_block, n0:n0 + n_length]
+            m = vData.shape[0]
+            if vQ is None:
+                if buffer_real is None:
+                    buffer_real = np.empty((n_block, 2 * n_freq),
+                                           dtype=kernel_real.dtype)
+                # convert data type if needed, through reused buffer
+                if vData.dtype != kernel_real.dtype:
+                    if buffer_data is None:
+                        buffer_data = np.empty((n_block, n_length),
+                                               dtype=kernel_real.dtype)
+                    buffer_data[:m] = vData
+                    vData = buffer_data[:m]
+                out = np.dot(vData, kernel_real, out=buffer_real[:m])
+                values.append(out[:, :n_freq] + 1j * out[:, n_freq:])
+            else:
+                if buffer_iq is None:
+                    buffer_iq = np.empty((n_block, n_length),
+                                         dtype=kernel.dtype)
+                    buffer_complex = np.empty((n_block, n_freq),
+                                              dtype=kernel.dtype)
+                vIQ = buffer_iq[:m]
+                vIQ.real = vData
+                vIQ.imag = vQ[k:k + n_block, n0:n0 + n_length]
+                out = np.dot(vIQ, kernel, out=buffer_complex[:m])
+                values.append(out.copy())
+    if len(values) == 0:
+        return np.zeros((0, n_freq), dtype=complex)
+    return np.concatenate(values).astype(complex, copy=False)
+
+
+def correct_phase(values, values_ref):
+    """Subtract the phase of the reference signal, in-place.
+
+    Parameters
+    ----------
+    values : complex numpy array
+        Demodulated signal, shape (n_segment, n_freq)
+
+    values_ref : complex numpy array
+        Demodulated reference, same shape as values
+
+    Returns
+    -------
+    values : complex numpy array
+        Demodulated signal with reference phase removed
+
+    """
+    dAngleRef = np.arctan2(values_ref.imag, values_ref.real)
+    values /= (np.cos(dAngleRef) + 1j * np.sin(dAngleRef))
+    return values
+
+
+def demodulate(data, dt, frequencies, skip, length, ref=None, scale=2.0,
+               dtype=np.float64, block_size=BLOCK_SIZE, training=None):
+    """Demodulate 2D segment data at one or more frequencies.
+
+    Parameters
+    ----------
+    data : numpy array or tuple
+        Records as 2D real or complex array, shape (n_segment, n_sample), or
+        tuple of 2D (I, Q) arrays
+
+    dt : float
+        Time step of input data
+
+    frequencies : list of float
+        Demodulation frequencies
+
+    skip : float
+        Time to skip at start of each record, in seconds
+
+    length : float
+        Length of integration window, in seconds
+
+    ref : numpy array
+        Reference records, same shape as data, or None
+
+    scale : float
+        Overall scale factor, 2 for real data and 1 for complex I/Q data
+
+    dtype : numpy dtype
+        Real data type used for integration, float64 or float32
+
+    block_size : int
+        Max number of segments integrated at once
+
+    training : tuple
+        Training traces (training_0, training_1) for matched-filter
+        weights, or None for box integration.  Box integration is also
+        used if the training traces do not match the data
+
+    Returns
+    -------
+    values : complex numpy array
+        Complex array with shape (n_segment, n_freq), or None if the
+        integration window is empty
+
+    """
+    n_sample = (data[0] if isinstance(data, tuple) else data).shape[1]
+    (n0, n_length) = get_indices(dt, skip, length, n_sample)
+    if n_length <= 1:
+        return None
+    (kernel, kernel_real) = get_kernel(frequencies, dt, n0, n_length,
+                                       scale, dtype)
+    if training is not None:
+        weights = get_weights(training[0], training[1], frequencies, dt,
+                              n0, n_length)
+        if weights is not None:
+            (kernel, kernel_real) = apply_weights(kernel, weights)
+    values = integrate(data, kernel, kernel_real, n0, block_size)
+    if ref is not None:
+        values_ref = integrate(ref, kernel, kernel_real, n0, block_size)
+        correct_phase(values, values_ref)
+    return values
@@ -2,26 +2,162 @@
 import numpy as np
 import scipy.linalg as splin
 import time
-import sys
+import functools
+import multiprocessing
 
 # add logger, to allow logging to Labber's instrument log
 import logging
 log = logging.getLogger('LabberDriver')
 
-MAC = (sys.platform == 'darwin')
 
-if MAC:
-    pass
-#    import pyximport
-#    pyximport.install(setup_args={"include_dirs":np.get_include()},
-#                      reload_support=True)
-else:
-    pass
-#    pyximport.install(setup_args={"script_args":["--compiler=mingw32"],
-#                      "include_dirs":np.get_include()},
-#                      reload_support=True)
+def _propagator(mDelta, mDetuning, mY, mDTime):
+    # elements of the time-evolution operator for a constant Hamiltonian
+    # applied during time mDTime, same expressions as integrateH(y)
+    # if mY is None, the Hamiltonian has no Y-term, as in integrateH
+    if mY is None:
+        mEnergy = 0.5 * np.sqrt(mDelta**2 + mDetuning**2)
+    else:
+        mEnergy = 0.5 * np.sqrt(mDelta**2 + mDetuning**2 + mY**2)
+    mAngle = 2*np.pi*mEnergy*mDTime
+    mCos = np.cos(mAngle)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mSinEn = np.sin(mAngle) / mEnergy
+    if mY is not None:
+        # take care of sin(x)/x division by zero
+        nan_indx = np.isnan(mSinEn)
+        mSinEn[nan_indx] = np.broadcast_to(2*np.pi*mDTime, mSinEn.shape)[nan_indx]
+    U11 = mCos + 1j*0.5*mDetuning*mSinEn
+    U22 = mCos - 1j*0.5*mDetuning*mSinEn
+    if mY is None:
+        U12 = 1j*0.5*mDelta*mSinEn
+        U21 = U12
+    else:
+        U12 = (mY + 1j*mDelta) * 0.5 * mSinEn
+        U21 = (-mY + 1j*mDelta) * 0.5 * mSinEn
+    return (U11, U12, U21, U22)
+
+
+def integrateHBatch(mStart, vTime, mDelta, mDetuning, mY=None, nReshape=1):
+    # simulate the time evolution for a batch of repetitions at once
+    # mStart is the start state, shape (2,) or (2, nRep)
+    # mDelta, mDetuning and mY are parameters for each repetition, with shape
+    # (nRep, nTime), or shape (nTime,) if shared between repetitions
+    # if mY is None, the Hamiltonian has no Y-term, as in integrateH
+    # returns states with shape (2, nRep, nOut), nOut = ceil(nTime/nReshape)
+    #
+    # the states are only kept every nReshape step, so the time-evolution
+    # operators are first multiplied together over each nReshape-step chunk,
+    # vectorized over chunks and repetitions.  The chunk operators are then
+    # applied to the states, vectorized over repetitions.
+    # Where the Hamiltonian is constant, as in idle periods, the operators
+    # are calculated in closed form: once for a whole chunk, and for runs of
+    # identical chunks all output states are calculated at once
+    nReshape = max(int(nReshape), 1)
+    nTime = len(vTime)
+    vDTime = np.diff(vTime)
+    # expand parameters shared between repetitions
+    mStart = np.asarray(mStart, dtype='complex128')
+    if mStart.ndim == 1:
+        mStart = mStart[:, np.newaxis]
+    lParam = [mDelta, mDetuning, mY]
+    nRep = max([mStart.shape[1]] + [np.shape(m)[0] for m in lParam
+                                    if m is not None and np.ndim(m) > 1])
+    mStart = np.broadcast_to(mStart, (2, nRep))
+    # parameters at start of each time step
+    lParam = [None if m is None else
+              np.broadcast_to(np.asarray(m)[..., :-1], (nRep, nTime - 1))
+              for m in lParam]
+    nOut = (nTime - 1) // nReshape + 1
+    nChunk = nOut - 1
+    mState = np.zeros((2, nRep, nOut), dtype='complex128')
+    mState[:, :, 0] = mStart
+    if nChunk == 0:
+        return mState
+    # find steps with same Hamiltonian and time step as the previous step
+    vSame = np.zeros(nTime - 1, dtype=bool)
+    vSame[1:] = np.isclose(vDTime[1:], vDTime[:-1], rtol=1E-9, atol=0)
+    for m in lParam:
+        if m is not None:
+            vSame[1:] &= np.all(m[:, 1:] == m[:, :-1], axis=0)
+    # first step and duration of each chunk, and check if chunk is constant
+    vFirst = nReshape * np.arange(nChunk)
+    vDuration = vTime[vFirst + nReshape] - vTime[vFirst]
+    vConst = np.all(vSame[:nChunk*nReshape].reshape(
+        (nChunk, nReshape))[:, 1:], axis=1)
+    # multiply operators within each chunk, P = U[nReshape-1]...U[1]U[0]
+    (P11, P12, P21, P22) = [np.zeros((nRep, nChunk), dtype='complex128')
+                            for n in range(4)]
+    indx = np.flatnonzero(vConst)
+    if len(indx) > 0:
+        # constant chunks, one operator for the whole chunk
+        lU = _propagator(*([None if m is None else m[:, vFirst[indx]]
+                            for m in lParam] + [vDuration[indx]]))
+        for P, U in zip((P11, P12, P21, P22), lU):
+            P[:, indx] = U
+    indx = np.flatnonzero(~vConst)
+    if len(indx) > 0:
+        for n1 in range(nReshape):
+            vStep = vFirst[indx] + n1
+            (U11, U12, U21, U22) = _propagator(
+                *([None if m is None else m[:, vStep] for m in lParam] +
+                  [vDTime[vStep]]))
+            if n1 == 0:
+                (Q11, Q12, Q21, Q22) = (U11, U12, U21, U22)
+            else:
+                (Q11, Q12, Q21, Q22) = (U11*Q11 + U12*Q21, U11*Q12 + U12*Q22,
+                                        U21*Q11 + U22*Q21, U21*Q12 + U22*Q22)
+        for P, Q in zip((P11, P12, P21, P22), (Q11, Q12, Q21, Q22)):
+            P[:, indx] = Q
+    # find runs of identical constant chunks
+    vCont = np.zeros(nChunk, dtype=bool)
+    vCont[1:] = (vConst[1:] & vConst[:-1] & vSame[vFirst[1:]] &
+                 np.isclose(vDuration[1:], vDuration[:-1], rtol=1E-9, atol=0))
+    vRunStart = np.flatnonzero(~vCont)
+    vRunStop = np.r_[vRunStart[1:], nChunk]
+    # apply chunk operators to the states
+    for (n1, n2) in zip(vRunStart, vRunStop):
+        if n2 - n1 == 1:
+            mState[0, :, n1+1] = P11[:, n1]*mState[0, :, n1] + P12[:, n1]*mState[1, :, n1]
+            mState[1, :, n1+1] = P21[:, n1]*mState[0, :, n1] + P22[:, n1]*mState[1, :, n1]
+        else:
+            # closed form for all states in run
+            vTimeRun = vTime[vFirst[n1:n2] + nReshape] - vTime[vFirst[n1]]
+            (U11, U12, U21, U22) = _propagator(
+                *([None if m is None else m[:, vFirst[n1], np.newaxis]
+                   for m in lParam] + [vTimeRun]))
+            vPsi0 = mState[0, :, n1, np.newaxis]
+            vPsi1 = mState[1, :, n1, np.newaxis]
+            mState[0, :, n1+1:n2+1] = U11*vPsi0 + U12*vPsi1
+            mState[1, :, n1+1:n2+1] = U21*vPsi0 + U22*vPsi1
+    return mState
+
+
+def _nextpow2(i):
+    # smallest power of two, at least 2, that is not smaller than i
+    return max(2, 1 << (int(i) - 1).bit_length())
+
+
+@functools.lru_cache(maxsize=16)
+def _get1fSpectrum(dTimeStep, nPts):
+    # amplitude of 1/f noise spectrum, for frequencies up to Nyquist
+    vFreq = np.linspace(0, 1/(2*dTimeStep), nPts+1)[1:]
+    vAmp = np.sqrt((vFreq[1] - vFreq[0])/vFreq)
+    vAmp.flags.writeable = False
+    return vAmp
 
-from _integrateHNoNumpy_ForDriver import integrateH, integrateHy
+
+def _initWorker(lShared, shape):
+    # keep output arrays in shared memory as globals in the worker process
+    global _lWorkerOutput
+    _lWorkerOutput = [np.frombuffer(x, dtype=float).reshape(shape)
+                      for x in lShared]
+
+
+def _simulateWorker(args):
+    # simulate a range of repetitions in a worker process
+    (dCfg, nStart, nStop, seed) = args
+    QubitSimulator().simulateReps(dCfg, nStart, nStop, *_lWorkerOutput,
+                                  seed=seed)
 
 #import matplotlib.pyplot as plt
 
@@ -45,43 +181,41 @@ class NoiseCfg():
         if bEmpty:
             self.deltaAmp = 0
             
-    def calc1fNoise(self, dTimeStep, nPtsIn=1):
-        def nextpow2(i):
-            n = 2
-            while n < i:
-                n = n * 2
-            return n
-            
-        # make nPts even number
-#        nPts = 2*np.ceil(nPtsIn/2.)
-        nPts = nextpow2(nPtsIn)
-        # define frequency information
-        # low and high cut-offs
-        dFs = 1/(dTimeStep)
-        dHighCut = dFs/2
-        vFreq = np.linspace(0, dHighCut, nPts+1)
-        # remove zero frequency
-        vFreq = vFreq[1:]
-        # create frequency data
-        vFreqData = np.sqrt(np.diff(vFreq[0:2])/vFreq)
-        # add random phase factor
-        vFreqData = vFreqData*np.exp(1j*2*np.pi*np.random.rand(len(vFreqData)))
-        # add zero frequency part
-        vFreq = np.r_[0, vFreq[1:-1]]
-        vFreqData = np.r_[0, vFreqData, vFreqData[-2::-1]]
-        vTimeData = len(vFreqData) * np.real(np.fft.ifft(vFreqData))#, \
-#                                             nextpow2(len(vFreqData))))
+    def calc1fNoise(self, dTimeStep, nPtsIn=1, nRep=None, rng=None):
+        # calculate 1/f noise vector, or matrix with nRep realizations
+        if rng is None:
+            rng = np.random.default_rng()
+        nPts = _nextpow2(nPtsIn)
+        # spectral shaping, only depends on time step and length
+        vAmp = _get1fSpectrum(dTimeStep, nPts)
+        shape = (nPts,) if nRep is None else (nRep, nPts)
+        # add random phase factor, only real part of spectrum contributes
+        mFreqData = np.zeros(shape[:-1] + (nPts+1,))
+        mFreqData[..., 1:] = vAmp*np.cos(2*np.pi*rng.random(shape))
+        # inverse real FFT, with same normalization as a full-length FFT
+        mTimeData = 2*nPts * np.fft.irfft(mFreqData, 2*nPts, axis=-1)
         # cut extra elements
-        vTimeData = vTimeData[0:nPtsIn]
-        return vTimeData
+        return mTimeData[..., 0:nPtsIn]
 
             
-    def getNoise(self, dTimeStep, nLen=1):
-        # caclulates a noise vector
+    def getNoise(self, dTimeStep, nLen=1, nRep=None, rng=None):
+        # caclulates a noise vector, or a matrix with one row per repetition
         # 
+        mHeld = self.getHeldNoise(dTimeStep, nLen, nRep, rng)
+        if np.isscalar(mHeld):
+            return mHeld
+        # full-length vector, this makes a copy of the held elements
+        return mHeld.reshape(mHeld.shape[:-2] + (-1,))[..., 0:nLen]
+
+
+    def getHeldNoise(self, dTimeStep, nLen=1, nRep=None, rng=None):
+        # calculates the noise as a read-only view with shape (..., nElem, nConst),
+        # where each unique element is held for nConst time steps
         if self.model == NoiseCfg.NOISESTATIC:
             # static noise, don't return any time-dependent noise
             return 0.0
+        if rng is None:
+            rng = np.random.default_rng()
         #
         # calculate smallest time step of the noise
         dtNoise = 1./(2.*self.hiCutOff)
@@ -95,42 +229,65 @@ class NoiseCfg():
         # get the unique noise vector
         if self.model == NoiseCfg.NOISE1F:
             # 1/f noise
-            vUnique = self.calc1fNoise(dtNoise, nElem)
+            vUnique = self.calc1fNoise(dtNoise, nElem, nRep, rng)
         elif self.model == NoiseCfg.NOISEWHITE:
             # white noise, return a vector
-            vUnique = np.random.randn(nElem) #*np.sqrt(1/dtNoise)
-        # create the full-length vector by keeping constant elements
-        vNoise = np.reshape(np.outer(vUnique, np.ones(nConst)), nElem*nConst)
-        return vNoise[0:nLen]
-#        # create linear interpolation between elements
-#        vdNoise = np.diff(vUnique)
-#        vdNoise = np.append(vdNoise, 0)
-#        vShift = np.reshape(np.outer(vdNoise, np.arange(nConst)/nConst), nElem*nConst)
-#        return vNoise[0:nLen] + vShift[0:nLen]
-
-
-    def addNoise(self, vDelta, vDetuning, dTimeStep, dScale=1):
-        # add noise to delta and detuning vectors
-        vNoise = self.getNoise(dTimeStep, max(len(vDelta), len(vDetuning)))
+            shape = (nElem,) if nRep is None else (nRep, nElem)
+            vUnique = rng.standard_normal(shape) #*np.sqrt(1/dtNoise)
+        # keep constant elements by broadcasting, without copying
+        vUnique = vUnique[..., 0:nElem]
+        return np.broadcast_to(vUnique[..., None], vUnique.shape + (nConst,))
+
+
+    def addHeldNoise(self, vTarget, mHeld, dScale):
+        # add held noise in-place to a vector, or matrix with one row per
+        # repetition, through a view with the shape of the held noise
+        nConst = mHeld.shape[-1]
+        nFull = vTarget.shape[-1] // nConst
+        nTail = vTarget.shape[-1] - nFull*nConst
+        if nFull > 0:
+            mView = vTarget[..., 0:nFull*nConst].reshape(
+                vTarget.shape[:-1] + (nFull, nConst))
+            if np.shares_memory(mView, vTarget):
+                mView += dScale*mHeld[..., 0:nFull, :]
+            else:
+                vTarget[..., 0:nFull*nConst] += dScale*mHeld[..., 0:nFull, :].reshape(
+                    mView.shape[:-2] + (-1,))
+        if nTail > 0:
+            vTarget[..., nFull*nConst:] += dScale*mHeld[..., nFull, 0:nTail]
+
+
+    def addNoise(self, vDelta, vDetuning, dTimeStep, dScale=1, rng=None):
+        # add noise to delta and detuning vectors, or to matrices with
+        # one row per repetition
+        vDelta = np.asarray(vDelta)
+        nRep = vDelta.shape[0] if vDelta.ndim > 1 else None
+        mNoise = self.getHeldNoise(dTimeStep, max(vDelta.shape[-1],
+                                   np.shape(vDetuning)[-1]), nRep, rng)
+        if np.isscalar(mNoise):
+            return
         # add noise only if amplitude is not zero
         if self.deltaAmp!=0:
-            vDelta += (self.deltaAmp)*vNoise*dScale
+            self.addHeldNoise(vDelta, mNoise, (self.deltaAmp)*dScale)
         if self.epsAmp!=0:
-            vDetuning += (self.epsAmp)*vNoise*dScale
+            self.addHeldNoise(vDetuning, mNoise, (self.epsAmp)*dScale)
             
 
-    def addStaticNoise(self, vDelta, vDetuning, vStaticDrive, dHighFreq, dScale=1):
+    def addStaticNoise(self, vDelta, vDetuning, vStaticDrive, dHighFreq,
+                       dScale=1, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
         nElem = max(len(vDelta), len(vDetuning))
         if self.model == NoiseCfg.NOISESTATIC:
             # static noise, create noise vector
-            vNoise =  np.random.randn(nElem)
+            vNoise = rng.standard_normal(nElem)
         elif self.model == NoiseCfg.NOISE1F and self.bAddStatic:
             # for 1/f, add noise at rep rate
             # calculate noise level from 1/f limits
             dIntNoise = np.sqrt(np.log(10)*(np.log10(dHighFreq) - 
                               np.log10(self.repRate)))
             # add noise to delta and detuning vectors
-            vNoise = np.random.randn(nElem)*dIntNoise
+            vNoise = rng.standard_normal(nElem)*dIntNoise
         else:
             # all other cases, add no noise
             vNoise = 0.0
@@ -154,6 +311,9 @@ class NoiseCfg():
 
 class QubitSimulator():
 
+    # max number of time steps times repetitions simulated at once
+    BATCH_SIZE = 2**20
+
     def __init__(self, simCfg = None):
         # init the object variables
         self.dDelta = 5
@@ -162,6 +322,8 @@ class QubitSimulator():
         self.nReshape = 100
         self.dDetuning = 0
         self.nRep = 1
+        self.nWorker = 1
+        self.nSeed = None
         self.dDriveFreq = 0
         self.bRelFreq = True
         self.bRWA = False
@@ -298,16 +460,15 @@ class QubitSimulator():
         #
         # pre-allocate result vector
         vTimeReshape = vTime[0::nReshape]
-        vP1 = np.zeros(len(vTimeReshape))
-        vPx = np.zeros(len(vTimeReshape))
-        vPy = np.zeros(len(vTimeReshape))
         #
         self.mPx = np.zeros((nRep, len(vTimeReshape)))
         self.mPy = np.zeros((nRep, len(vTimeReshape)))
         self.mPz = np.zeros((nRep, len(vTimeReshape)))
-        #
-        mSx = np.array([[0., 1.],[1., 0.]])
-        mSy = np.array([[0., -1j],[1j, 0.]])
+        # independent random streams for static noise and for each worker,
+        # reproducible if a seed is given
+        nWorker = min(max(int(self.nWorker), 1), nRep)
+        lSeed = np.random.SeedSequence(self.nSeed).spawn(nWorker + 1)
+        rng = np.random.default_rng(lSeed.pop(0))
         # create static noise vector
         vStaticDelta = np.zeros(nRep)
         vStaticDet = np.zeros(nRep)
@@ -317,9 +478,11 @@ class QubitSimulator():
             dStaticHF = 1/(1e-9*vTime[-1])
             for noise in lNoise:
                 noise.addStaticNoise(vStaticDelta, vStaticDet, vStaticDrive, 
-                                     dStaticHF, 1E-9)
+                                     dStaticHF, 1E-9, rng)
 
         # figure out resampling of input noise
+        (noise_epsilon_t, noise_eps_m) = (None, None)
+        (noise_delta_t, noise_delta_m) = (None, None)
         if (noise_epsilon is not None):
             n = len(noise_epsilon['y']) // nRep
             noise_epsilon_t = np.arange(n) * noise_epsilon['dt'] * 1E9
@@ -333,6 +496,7 @@ class QubitSimulator():
             noise_delta_m = 1E-9 * noise_delta['y'][:(nRep * n)].reshape((nRep, n))
 
         # find indices with pulses to be able to remove noise during pulses 
+        pulse_indx = None
         if self.bRemoveNoise:
             pulse_indx = np.where((np.abs(vI) + np.abs(vQ)) > 1E-15)[0]
 
@@ -341,87 +505,160 @@ class QubitSimulator():
         dNoiseColAmp = np.max(np.abs(vColNoise))
         if dNoiseColAmp>0:
             vColNoise /= dNoiseColAmp
+        # collect configuration needed to simulate a range of repetitions
+        dCfg = dict(vStart=vStart, vTime=vTime, vTimeReshape=vTimeReshape,
+                    dTimeStep=dTimeStep, dTimeZero=dTimeZero, vDrive=vDrive,
+                    dDelta=dDelta, dDetuning=dDetuning, dDriveFreq=dDriveFreq,
+                    nReshape=nReshape, nRep=nRep, lNoise=lNoise, bRWA=bRWA,
+                    bRotFrame=bRotFrame, vStaticDelta=vStaticDelta,
+                    vStaticDet=vStaticDet, vStaticDrive=vStaticDrive,
+                    noise_epsilon_t=noise_epsilon_t, noise_eps_m=noise_eps_m,
+                    noise_delta_t=noise_delta_t, noise_delta_m=noise_delta_m,
+                    pulse_indx=pulse_indx, bRemoveNoise=self.bRemoveNoise,
+                    bDriveCharge=self.bDriveCharge, nBatchSize=self.BATCH_SIZE)
+        if nWorker > 1:
+            self.simulateParallel(dCfg, lSeed)
+        else:
+            self.simulateReps(dCfg, 0, nRep, self.mPz, self.mPx, self.mPy,
+                              lSeed[0])
+        vP1 = np.sum(self.mPz, axis=0)
+        vPx = np.sum(self.mPx, axis=0)
+        vPy = np.sum(self.mPy, axis=0)
+
+        # divide to get average
+        vP1 = vP1/nRep
+        vPx = vPx/nRep
+        vPy = vPy/nRep
+        # convert to projections
+        vP1 = -(2*vP1 - 1)
+        vPx = 2*vPx - 1
+        vPy = 2*vPy - 1
+        self.mPz = -(2*self.mPz - 1)
+        self.mPx = 2*self.mPx - 1
+        self.mPy = 2*self.mPy - 1
+        return  (vP1, vPx, vPy, vTimeReshape, vColNoise)
+
+
+    def simulateReps(self, dCfg, nStart, nStop, mPz, mPx, mPy, seed=None):
+        # simulate repetitions nStart to nStop, with configuration from
+        # simulate, and store projections in rows of mPz, mPx and mPy
+        rng = np.random.default_rng(seed)
+        vStart = dCfg['vStart']
+        vTime = dCfg['vTime']
+        vTimeReshape = dCfg['vTimeReshape']
+        (dTimeStep, dTimeZero) = (dCfg['dTimeStep'], dCfg['dTimeZero'])
+        vDrive = dCfg['vDrive']
+        (dDelta, dDetuning) = (dCfg['dDelta'], dCfg['dDetuning'])
+        dDelta0 = dDelta
+        (dDriveFreq, nReshape) = (dCfg['dDriveFreq'], dCfg['nReshape'])
+        (nRep, lNoise) = (dCfg['nRep'], dCfg['lNoise'])
+        (bRWA, bRotFrame) = (dCfg['bRWA'], dCfg['bRotFrame'])
+        vStaticDelta = dCfg['vStaticDelta']
+        vStaticDet = dCfg['vStaticDet']
+        vStaticDrive = dCfg['vStaticDrive']
+        noise_epsilon_t = dCfg['noise_epsilon_t']
+        noise_eps_m = dCfg['noise_eps_m']
+        noise_delta_t = dCfg['noise_delta_t']
+        noise_delta_m = dCfg['noise_delta_m']
+        pulse_indx = dCfg['pulse_indx']
+        #
+        mSx = np.array([[0., 1.],[1., 0.]])
+        mSy = np.array([[0., -1j],[1j, 0.]])
         # rotatation matrice
         mRotX = splin.expm(-1j*0.5*np.pi*0.5*mSx)
         mRotY = splin.expm(-1j*0.5*np.pi*0.5*mSy)
-        for n1 in range(nRep):
+        # repetitions are simulated in batches, to bound memory usage
+        nBatch = max(1, dCfg['nBatchSize'] // max(len(vTime), 1))
+        for nFirst in range(nStart, nStop, nBatch):
+            lRep = range(nFirst, min(nFirst + nBatch, nStop))
             # create new vectors for delta and detuning for each time step
-            vDelta = np.zeros(len(vTime)) + vStaticDelta[n1]
-            vDetuning = np.zeros(len(vTime)) + vStaticDet[n1]
+            mDelta = np.zeros((len(lRep), len(vTime)))
+            mDetuning = np.zeros((len(lRep), len(vTime)))
+            mDelta += vStaticDelta[lRep.start:lRep.stop, np.newaxis]
+            mDetuning += vStaticDet[lRep.start:lRep.stop, np.newaxis]
 
-            # add noise to both delta and epsilon from all noise sources
+            # add noise to both delta and epsilon from all noise sources,
+            # for all repetitions in the batch at once
             if nRep>1:
                 for noise in lNoise:
-                    noise.addNoise(vDelta, vDetuning, dTimeStep*1E-9, 1E-9)
-
-            # add externally applied noise for the right repetition
-            if (noise_epsilon is not None):
-                noise_data = np.interp(vTime, noise_epsilon_t, noise_eps_m[n1])
-                vDetuning += noise_data
-            if (noise_delta is not None):
-                noise_data = np.interp(vTime, noise_delta_t, noise_delta_m[n1])
-                vDelta += noise_data
-
-            # if wanted, remove noise where pulses are applied
-            if self.bRemoveNoise:
-                vDelta[pulse_indx] = 0.0
-                vDetuning[pulse_indx] = 0.0
+                    noise.addNoise(mDelta, mDetuning, dTimeStep*1E-9, 1E-9, rng)
+
+            for n2, n1 in enumerate(lRep):
+                vDelta = mDelta[n2]
+                vDetuning = mDetuning[n2]
+                # add externally applied noise for the right repetition
+                if (noise_eps_m is not None):
+                    noise_data = np.interp(vTime, noise_epsilon_t, noise_eps_m[n1])
+                    vDetuning += noise_data
+                if (noise_delta_m is not None):
+                    noise_data = np.interp(vTime, noise_delta_t, noise_delta_m[n1])
+                    vDelta += noise_data
+
+                # if wanted, remove noise where pulses are applied
+                if dCfg['bRemoveNoise']:
+                    vDelta[pulse_indx] = 0.0
+                    vDetuning[pulse_indx] = 0.0
 
             # combine noise with static bias points
-            vDelta += dDelta
-            vDetuning += dDetuning
- 
-             # do simulation, either using RWA or full Hamiltonian
+            mDelta += dDelta
+            mDetuning += dDetuning
+            vDriveScale = (1.0 + vStaticDrive[lRep.start:lRep.stop])[:, np.newaxis]
+
+            # do simulation for all repetitions in the batch, either using
+            # RWA or full Hamiltonian
             if bRWA:
                 # new frame, refer to drive frequency
-                vDetuning = np.sqrt(vDetuning**2 + vDelta**2) - dDriveFreq
-                mState = integrateHy(vStart, vTime, np.real(vDrive), vDetuning, 
-                                     -np.imag(vDrive), nReshape)
-                # mState = self.integrateH(vStart, vTime, np.real(vDrive), vDetuning, 
-                #     np.imag(vDrive), nReshape)
-
+                mDetuning = np.sqrt(mDetuning**2 + mDelta**2) - dDriveFreq
+                mState = integrateHBatch(vStart, vTime, np.real(vDrive),
+                                         mDetuning, -np.imag(vDrive), nReshape)
             else:
                 # two different methonds depending if using Y-drive or not
-                if self.bDriveCharge:
+                if dCfg['bDriveCharge']:
                     # drive on Y (= charge)
-                    vY = vDrive * (1.0 + vStaticDrive[n1])
-                    mState = integrateHy(vStart, vTime, vDelta, vDetuning, vY, nReshape)
-                    # mState = self.integrateH(vStart, vTime, vDelta, vDetuning, vY, nReshape)
+                    mY = vDrive * vDriveScale
+                    mState = integrateHBatch(vStart, vTime, mDelta, mDetuning,
+                                             mY, nReshape)
                 else:
                     # drive on Z (= flux)
-                    vDetuning += vDrive * (1.0 + vStaticDrive[n1])
-                    mState = integrateH(vStart, vTime, vDelta, vDetuning, nReshape)
-                    # vY = np.zeros_like(vDrive)
-                    # mState = self.integrateH(vStart, vTime, vDelta, vDetuning, vY, nReshape)
+                    mDetuning += vDrive * vDriveScale
+                    mState = integrateHBatch(vStart, vTime, mDelta, mDetuning,
+                                             None, nReshape)
                 # convert the results to an eigenbasis of dDelta, dDetuning
-                mState = self.convertToEigen(mState, dDelta0, dDetuning)
+                shape = mState.shape
+                mState = self.convertToEigen(
+                    mState.reshape((2, -1)), dDelta0, dDetuning).reshape(shape)
                 # go to the rotating frame (add timeStep/2 to get the right phase)
                 if bRotFrame:
                     mState = self.goToRotatingFrame(mState, vTimeReshape, dDriveFreq, dTimeZero+dTimeStep/2)
             # get probablity of measuring p1
-            mStateEig = mState
-            self.mPz[n1,:] = np.real(mStateEig[1,:]*np.conj(mStateEig[1,:]))
-            vP1 += self.mPz[n1,:]
+            mStateEig = mState[1]
+            mPz[lRep.start:lRep.stop] = np.real(mStateEig*np.conj(mStateEig))
             # get projection on X and Y
-            mStateEig = np.dot(mRotX,mState)
-            self.mPx[n1,:] = np.real(mStateEig[1,:]*np.conj(mStateEig[1,:]))
-            vPx += self.mPx[n1,:]
-            mStateEig = np.dot(mRotY,mState)
-            self.mPy[n1,:] = np.real(mStateEig[1,:]*np.conj(mStateEig[1,:]))
-            vPy += self.mPy[n1,:]
-
-        # divide to get average
-        vP1 = vP1/nRep
-        vPx = vPx/nRep
-        vPy = vPy/nRep
-        # convert to projections
-        vP1 = -(2*vP1 - 1)
-        vPx = 2*vPx - 1
-        vPy = 2*vPy - 1
-        self.mPz = -(2*self.mPz - 1)
-        self.mPx = 2*self.mPx - 1
-        self.mPy = 2*self.mPy - 1
-        return  (vP1, vPx, vPy, vTimeReshape, vColNoise)
+            mStateEig = mRotX[1,0]*mState[0] + mRotX[1,1]*mState[1]
+            mPx[lRep.start:lRep.stop] = np.real(mStateEig*np.conj(mStateEig))
+            mStateEig = mRotY[1,0]*mState[0] + mRotY[1,1]*mState[1]
+            mPy[lRep.start:lRep.stop] = np.real(mStateEig*np.conj(mStateEig))
+
+
+    def simulateParallel(self, dCfg, lSeed):
+        # simulate repetitions in parallel, one process per random stream in
+        # lSeed.  Results are written directly to arrays in shared memory
+        nWorker = len(lSeed)
+        shape = self.mPz.shape
+        lShared = [multiprocessing.RawArray('d', int(np.prod(shape)))
+                   for n in range(3)]
+        (self.mPz, self.mPx, self.mPy) = [
+            np.frombuffer(x, dtype=float).reshape(shape) for x in lShared]
+        nRep = shape[0]
+        vSplit = np.linspace(0, nRep, nWorker + 1).astype(int)
+        lArgs = [(dCfg, vSplit[n], vSplit[n+1], lSeed[n])
+                 for n in range(nWorker)]
+        pool = multiprocessing.Pool(nWorker, _initWorker, (lShared, shape))
+        try:
+            pool.map(_simulateWorker, lArgs)
+        finally:
+            pool.close()
+            pool.join()
 
 
     def getDriveVector(self, dPos = 0, iPos=None):
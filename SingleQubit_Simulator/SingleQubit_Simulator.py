@@ -62,6 +62,9 @@ class Driver(InstrumentDriver.InstrumentWorker):
                        dTimeStep=1E9*self.getValue('Time step, simulation'),
                        dDetuning=self.getValue('Epsilon')/1E9,
                        nRep=int(self.getValue('Number of randomizations')),
+                       nWorker=int(self.getValue('Number of worker processes')),
+                       # seed zero gives a new random seed for each simulation
+                       nSeed=int(self.getValue('Random seed')) or None,
                        dDriveFreq=self.getValue('Drive frequency')/1E9,
                        bRelFreq=bool(self.getValue('Drive relative to qubit frequency')),
                        bRotFrame=bool(self.getValue('Use rotating frame')),
@@ -1,28 +1,174 @@
 #!/usr/bin/env python
 
+import glob
+import hashlib
+import os
+import pickle
+import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from BaseDriver import LabberDriver
 import numpy as np
+import sklearn
 from sklearn.svm import SVC
 
 
 class Error(Exception):
     pass
 
+
+class LookupGrid(object):
+    """Classifier compiled into a dense 2D decision grid over the IQ plane.
+
+    The grid is evaluated once with the exact classifier, after which each
+    point is classified by a vectorized index lookup.  Grid bounds are given
+    by the training data, points outside the grid are assigned the state of
+    the nearest edge cell.
+    """
+
+    def __init__(self, classifier, X, n_grid=256, margin=0.5):
+        self.classifier = classifier
+        self.n_grid = int(n_grid)
+        # bounds from training data, expanded by margin
+        x_min = np.min(X, axis=0)
+        x_max = np.max(X, axis=0)
+        span = np.maximum(x_max - x_min, 1E-12)
+        span = np.maximum(span, np.max(span) * 0.1)
+        self.x0 = x_min - margin * span
+        self.dx = (1 + 2 * margin) * span / self.n_grid
+        # evaluate exact classifier at cell centers
+        vX = self.x0[0] + self.dx[0] * (np.arange(self.n_grid) + 0.5)
+        vY = self.x0[1] + self.dx[1] * (np.arange(self.n_grid) + 0.5)
+        (mX, mY) = np.meshgrid(vX, vY, indexing='ij')
+        points = np.column_stack((mX.ravel(), mY.ravel()))
+        self.grid = classifier.predict(points).reshape(
+            (self.n_grid, self.n_grid)).astype(int)
+        # agreement with exact classifier, evaluated on training data
+        self.agreement = np.mean(self.predict(X) == classifier.predict(X))
+
+    def predict(self, X):
+        """Predict states for points in array with shape (n, 2)"""
+        index = np.floor((X - self.x0) / self.dx).astype(int)
+        np.clip(index, 0, self.n_grid - 1, out=index)
+        return self.grid[index[:, 0], index[:, 1]]
+
+
+class GaussianDiscriminator(object):
+    """Linear or quadratic discriminant, from per-state means and covariances.
+
+    With a shared covariance matrix the decision boundaries are linear (LDA),
+    otherwise each state has its own covariance (QDA).  States with too few
+    training points to estimate a covariance use the pooled covariance, or
+    the identity matrix if no covariance can be estimated.
+    """
+
+    def __init__(self, X, y, n_state, shared_covariance=True):
+        self.means = np.zeros((n_state, 2))
+        self.offset = np.zeros(n_state)
+        covariances = np.zeros((n_state, 2, 2))
+        counts = np.zeros(n_state, dtype=int)
+        for k in range(n_state):
+            Xk = X[y == k]
+            counts[k] = len(Xk)
+            if counts[k] == 0:
+                # no training data for state, never assign
+                self.offset[k] = -np.inf
+                continue
+            self.means[k] = np.mean(Xk, axis=0)
+            if counts[k] > 2:
+                covariances[k] = np.cov(Xk, rowvar=False)
+        # pooled covariance
+        dof = np.maximum(counts - 1, 0) * (counts > 2)
+        if np.sum(dof) > 0:
+            pooled = np.einsum('k,kij->ij', dof, covariances) / np.sum(dof)
+        else:
+            pooled = np.eye(2)
+        for k in range(n_state):
+            if shared_covariance or counts[k] <= 2:
+                covariances[k] = pooled
+        # regularize, to avoid singular matrices
+        covariances += 1E-9 * np.trace(pooled) * np.eye(2)
+        self.precision = np.linalg.inv(covariances)
+        if not shared_covariance:
+            self.offset -= 0.5 * np.linalg.slogdet(covariances)[1]
+
+    def predict(self, X):
+        """Predict states for points in array with shape (n, 2)"""
+        return predict_gaussian([self], X[np.newaxis])[0]
+
+
+def predict_gaussian(models, X):
+    """Predict states for all qubits at once, using Gaussian discriminants.
+
+    The discriminant for each state is evaluated with a few multiply-adds per
+    point, vectorized over qubits and shots.
+
+    Parameters
+    ----------
+    models : list of GaussianDiscriminator
+        Discriminants for each qubit, with the same number of states
+
+    X : numpy array
+        Points to classify, with shape (n_qubit, n_shot, 2)
+
+    Returns
+    -------
+    states : numpy array
+        Integer array with shape (n_qubit, n_shot)
+
+    """
+    means = np.array([m.means for m in models])
+    precision = np.array([m.precision for m in models])
+    offset = np.array([m.offset for m in models])
+    best = np.full(X.shape[:2], -np.inf)
+    states = np.zeros(X.shape[:2], dtype=int)
+    for k in range(means.shape[1]):
+        dx = X[:, :, 0] - means[:, k, 0, np.newaxis]
+        dy = X[:, :, 1] - means[:, k, 1, np.newaxis]
+        score = (precision[:, k, 0, 0, np.newaxis] * dx * dx +
+                 2 * precision[:, k, 0, 1, np.newaxis] * dx * dy +
+                 precision[:, k, 1, 1, np.newaxis] * dy * dy)
+        score *= -0.5
+        score += offset[:, k, np.newaxis]
+        better = score > best
+        best[better] = score[better]
+        states[better] = k
+    return states
+
+
 class Driver(LabberDriver):
     """ This class implements a Labber driver"""
 
     MAX_QUBITS = 9
+    # trained models are persisted in this folder, keyed by content hash
+    MODEL_CACHE_PATH = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'model_cache')
+    # max number of models kept in memory, and on disk
+    MODEL_CACHE_SIZE = 100
 
     def performOpen(self, options={}):
         """Perform the operation of opening the instrument connection"""
         # define variables for training data sets
         self.training_cfg = {}
         self.init_training_data()
+        # in-memory cache of trained models
+        self.model_cache = {}
+        # classified states, cached as (classifiers, config, input traces)
+        self.states_cache = None
+        self.svm = []
+        self.qubit_states = [[]] * self.MAX_QUBITS
+        self.state_vector = np.array([], dtype=int)
+        self.state_histogram = np.zeros(0)
+        # thread pool for classifying qubits in parallel, created when needed
+        self.pool = None
 
 
     def performClose(self, bError=False, options={}):
         """Perform the close instrument connection operation"""
-        pass
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
 
 
     def performSetValue(self, quant, value, sweepRate=0.0, options={}):
@@ -58,8 +204,9 @@ class Driver(LabberDriver):
                 # data is for all qubits
                 self.training_data[qubit - 1][state] = training_vector
 
-        # if changing to use median, flag that re-training is necessary
-        elif quant.name.startswith('Use median value'):
+        # if changing to use median or lookup grid, flag re-training
+        elif quant.name in ('Use median value', 'Use lookup grid',
+                            'Grid size', 'Classifier'):
             self.training_valid = False
 
         # if changing pointer states, flag need for for re-training
@@ -84,10 +231,8 @@ class Driver(LabberDriver):
             qubit = int(quant.name[10]) - 1
             value = np.mean(self.qubit_states[qubit])
         elif quant.name.startswith('Average state vector'):
-            # states are encoded in array of ints
-            m = self.n_state ** self.n_qubit
-            value = (np.bincount(self.state_vector, minlength=m) /
-                     len(self.state_vector))
+            # histogram of states, calculated together with state vector
+            value = self.state_histogram
 
         elif quant.name.startswith('System state'):
             value = self.state_vector
@@ -128,7 +273,7 @@ class Driver(LabberDriver):
         if self.training_valid:
             return
 
-        # get SVM configuration
+        # get SVM configuration, only used by SVM classifier
         kwargs = dict(
             kernel=self.getValue('Kernel'),
             degree=self.getValue('Degree'),
@@ -176,11 +321,8 @@ class Driver(LabberDriver):
                 # increase counter
                 k += len(x)
 
-            # create SVM and fit data
-            svc = SVC(**kwargs)
-            svc.fit(X, y)
-            # store in list of SVMs
-            self.svm.append(svc)
+            # create classifier and fit data
+            self.svm.append(self.fit_classifier(qubit, X, y, kwargs))
 
         # mark training as valid
         self.training_valid = True
@@ -201,41 +343,203 @@ class Driver(LabberDriver):
                 X[m, 1] = x.imag
                 y[m] = m
 
-            # create SVM and fit data
-            svc = SVC(**kwargs)
-            svc.fit(X, y)
-            # store in list of SVMs
-            self.svm.append(svc)
+            # create classifier and fit data
+            self.svm.append(self.fit_classifier(qubit, X, y, kwargs))
 
         # mark training as valid
         self.training_valid = True
 
 
+    def fit_classifier(self, qubit, X, y, kwargs):
+        """Fit classifier for one qubit, and report assignment fidelity.
+        Trained models are re-used if training data and settings match"""
+        key = self.get_model_key(X, y, kwargs)
+        model = self.load_model(key)
+        if model is None:
+            model = self.train_classifier(qubit, X, y, kwargs)
+            self.store_model(key, model)
+        (classifier, fidelity) = model
+        self.setValue('Assignment fidelity, QB%d' % (qubit + 1), fidelity)
+        if isinstance(classifier, LookupGrid):
+            self.setValue('Grid agreement, QB%d' % (qubit + 1),
+                          classifier.agreement)
+        return classifier
+
+
+    def train_classifier(self, qubit, X, y, kwargs):
+        """Train classifier, return classifier and assignment fidelity"""
+        engine = self.getValue('Classifier')
+        if engine == 'SVM':
+            svc = SVC(**kwargs)
+            svc.fit(X, y)
+            classifier = self.compile_classifier(qubit, svc, X)
+        else:
+            classifier = GaussianDiscriminator(
+                X, y, self.n_state,
+                shared_covariance=(engine == 'Gaussian (LDA)'))
+        # assignment matrix on training data, rows are prepared states
+        output = classifier.predict(X)
+        matrix = np.bincount(y * self.n_state + output,
+                             minlength=self.n_state ** 2).reshape(
+                                 (self.n_state, self.n_state))
+        n_prepared = matrix.sum(axis=1)
+        valid = n_prepared > 0
+        fidelity = np.mean(np.diag(matrix)[valid] / n_prepared[valid])
+        return (classifier, fidelity)
+
+
+    def compile_classifier(self, qubit, svc, X):
+        """Compile trained SVM into lookup grid, if enabled"""
+        if not self.getValue('Use lookup grid'):
+            return svc
+        grid = LookupGrid(svc, X, n_grid=self.getValue('Grid size'))
+        if grid.agreement < 1.0:
+            self.log('QB%d: Lookup grid agrees with SVM for %.4f of ' %
+                     (qubit + 1, grid.agreement) + 'training points')
+        return grid
+
+
+    def get_model_key(self, X, y, kwargs):
+        """Hash of training data, classifier settings and training type"""
+        cfg = dict(kwargs)
+        cfg.update(
+            classifier=self.getValue('Classifier'),
+            use_grid=self.getValue('Use lookup grid'),
+            grid_size=self.getValue('Grid size'),
+            training_type=self.training_cfg.get('training_type'),
+            n_state=self.n_state,
+            # pickled models are only valid for the same versions
+            sklearn_version=sklearn.__version__,
+            python_version=platform.python_version())
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(X, dtype=float).tobytes())
+        h.update(np.ascontiguousarray(y, dtype=np.int64).tobytes())
+        h.update(repr(sorted(cfg.items())).encode())
+        return h.hexdigest()
+
+
+    def load_model(self, key):
+        """Get trained model from memory or disk cache, None if missing"""
+        if key in self.model_cache:
+            return self.model_cache[key]
+        if not self.getValue('Cache trained models'):
+            return None
+        path = os.path.join(self.MODEL_CACHE_PATH, key + '.pickle')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+            # mark as recently used, to keep it when pruning the cache
+            os.utime(path, None)
+        except Exception as e:
+            self.log('Could not load cached model: %s' % str(e), level=30)
+            return None
+        self.store_model(key, model, save=False)
+        return model
+
+
+    def store_model(self, key, model, save=True):
+        """Store trained model in memory and, if enabled, on disk"""
+        while len(self.model_cache) >= self.MODEL_CACHE_SIZE:
+            # remove oldest entry
+            self.model_cache.pop(next(iter(self.model_cache)))
+        self.model_cache[key] = model
+        if not (save and self.getValue('Cache trained models')):
+            return
+        try:
+            if not os.path.exists(self.MODEL_CACHE_PATH):
+                os.makedirs(self.MODEL_CACHE_PATH)
+            path = os.path.join(self.MODEL_CACHE_PATH, key + '.pickle')
+            # write to temporary file first, to never leave a partial file
+            (fd, path_temp) = tempfile.mkstemp(
+                suffix='.tmp', dir=self.MODEL_CACHE_PATH)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(model, f)
+                os.replace(path_temp, path)
+            except Exception:
+                os.remove(path_temp)
+                raise
+            self.prune_model_cache()
+        except Exception as e:
+            self.log('Could not save trained model: %s' % str(e), level=30)
+
+
+    def prune_model_cache(self):
+        """Remove least recently used models from disk cache"""
+        paths = glob.glob(os.path.join(self.MODEL_CACHE_PATH, '*.pickle'))
+        if len(paths) <= self.MODEL_CACHE_SIZE:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.MODEL_CACHE_SIZE]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
     def calculate_states(self):
-        """Calculate states using training data"""
+        """Calculate states using training data.  Results are re-used until
+        the input traces or the trained classifiers change"""
         # train discriminator, if necessary
         self.train_discriminator()
-        self.state_vector = np.array([], dtype=int)
+        # input traces for all active qubits, compared by identity
+        traces = [self.getValue('Input data, QB%d' % (n + 1))
+                  for n in range(len(self.svm))]
+        traces = [None if t is None else t['y'] for t in traces]
+        if (self.states_cache is not None and
+                self.states_cache[0] is self.svm and
+                self.states_cache[1] == self.training_cfg and
+                len(self.states_cache[2]) == len(traces) and
+                all(x is y for (x, y) in zip(self.states_cache[2], traces))):
+            return
+        # get input data for all active qubits
+        inputs = []
+        for n in range(len(self.svm)):
+            x = self.getValueArray('Input data, QB%d' % (n + 1))
+            input_data = np.zeros((len(x), 2))
+            input_data[:, 0] = x.real
+            input_data[:, 1] = x.imag
+            inputs.append(input_data)
+        # for Gaussian discriminants, classify all qubits at once
+        vectorized = (
+            len(inputs) > 0 and
+            all(isinstance(c, GaussianDiscriminator) for c in self.svm) and
+            len(set(len(x) for x in inputs)) == 1)
+        if vectorized:
+            outputs = list(predict_gaussian(self.svm, np.array(inputs)))
+        elif len(inputs) > 1:
+            # classify qubits in parallel, numpy/sklearn release the GIL
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.MAX_QUBITS)
+            outputs = list(self.pool.map(self.predict, self.svm, inputs))
+        else:
+            outputs = [self.predict(svm, x)
+                       for svm, x in zip(self.svm, inputs)]
         # calculate states for all active qubits
         self.qubit_states = [[]] * self.MAX_QUBITS
-        for n, svm in enumerate(self.svm):
-            x = self.getValueArray('Input data, QB%d' % (n + 1))
-            if len(x) > 0:
-                input_data = np.zeros((len(x), 2))
-                input_data[:, 0] = x.real
-                input_data[:, 1] = x.imag
-                output = svm.predict(input_data)
-            else:
-                output = np.array([], dtype=int)
+        for n, output in enumerate(outputs):
             self.qubit_states[n] = output
-
             # update mean value controls
             self.setValue('Average QB%d state' % (n + 1), np.mean(output))
-
-            # calculate state vector, in integer form
-            if n == 0:
-                self.state_vector = np.zeros(len(output), dtype=int)
-            self.state_vector += (output * (self.n_state ** n))
+        # joint state vector in integer form, and histogram of states
+        m = self.n_state ** self.n_qubit
+        n_shot = min([len(x) for x in outputs]) if len(outputs) > 0 else 0
+        self.state_vector = np.zeros(n_shot, dtype=int)
+        for n, output in enumerate(outputs):
+            self.state_vector += output[:n_shot] * (self.n_state ** n)
+        self.state_histogram = np.bincount(
+            self.state_vector, minlength=m) / max(n_shot, 1)
+        # keep references to inputs, to make identity check valid
+        self.states_cache = (self.svm, dict(self.training_cfg), traces)
+
+
+    def predict(self, classifier, X):
+        """Predict states for one qubit"""
+        if len(X) == 0:
+            return np.array([], dtype=int)
+        return classifier.predict(X)
 
 
 if __name__ == '__main__':
@@ -2,7 +2,8 @@
 
 import InstrumentDriver
 import numpy as np
-from scipy.signal import resample
+from fractions import Fraction
+from scipy.signal import resample_poly
 from scipy.ndimage.filters import gaussian_filter
 from scipy.optimize import leastsq
 from numpy.fft import fft, fftshift, fftfreq
@@ -55,42 +56,51 @@ class Driver(InstrumentDriver.InstrumentWorker):
             value = quant.getValue()
         return value
         
-    def demodulate(self, vWaveform):   
-      
-        #demodulate
+    def demodulate(self, vWaveform):
+        """Demodulate waveform, averaging over each modulation period"""
         nModFreq = self.getValue('Modulation Freq')
         nSampleRate = self.getValue('Sample Rate')
-        nWavLength = len(vWaveform)
-        vTvals = np.linspace(0,nWavLength/nSampleRate, nWavLength, endpoint = False)
-        
-        
-        
-        mod_period = 1/nModFreq
-        #period_num = int(np.floor((self.vRTime[-1]+dt)/mod_period))
-        response_int = []
-        t_int = []
-        
-        period_num = (vTvals[-1] - vTvals[0]) * nModFreq
-        samples_period = int(nSampleRate/nModFreq)
-        
-        vWaveform = resample(vWaveform, int(period_num*samples_period))#sinc function interpolation
-        
-        vTvals = np.linspace(0, nWavLength/nSampleRate, len(vWaveform), endpoint = False)
+        return demodulatePeriods(vWaveform, nSampleRate, nModFreq)
+
+
+def demodulatePeriods(vWaveform, dSampleRate, dModFreq, nMaxDenominator=1000):
+    """Demodulate waveform and average over each modulation period.
 
-        avg = np.mean(vWaveform)
-        demod = 2*(vWaveform-avg)*np.exp(-1j*(2*np.pi*(nModFreq)*vTvals))
+    The waveform is resampled with a polyphase filter so that each
+    modulation period contains an integer number of samples, no resampling
+    is done if the period already is an integer number of samples.  The
+    periods are then averaged with a single reshape-and-mean.  If the input
+    is 2D, each row is demodulated separately.
 
-        #integrate over each modulation period
-        vResponse = np.array([], dtype = complex)
-        t_int = []
-        for n in range(0,int(np.floor(period_num))):
-            start = n*samples_period
-            end = (n+1)*samples_period
-            vResponse = np.append(vResponse, np.mean(demod[start:end]))
-            t_int.append(np.mean(vTvals[start:end]))
+    Returns the modulation period and the complex response per period"""
+    vWaveform = np.asarray(vWaveform, dtype=float)
+    mod_period = 1/dModFreq
+    # number of samples per period after resampling
+    dSamplesPeriod = dSampleRate/dModFreq
+    samples_period = max(int(dSamplesPeriod), 1)
+    if abs(dSamplesPeriod - round(dSamplesPeriod)) < 1E-9*dSamplesPeriod:
+        # exact integer number of samples per period, no resampling needed
+        samples_period = int(round(dSamplesPeriod))
+        dNewRate = dSampleRate
+    else:
+        # rational resampling ratio giving integer samples per period
+        ratio = Fraction(samples_period*dModFreq/dSampleRate)
+        ratio = ratio.limit_denominator(nMaxDenominator)
+        vWaveform = resample_poly(vWaveform, ratio.numerator,
+                                  ratio.denominator, axis=-1)
+        dNewRate = dSampleRate*ratio.numerator/ratio.denominator
+    nPoints = vWaveform.shape[-1]
+    nPeriod = nPoints // samples_period
+    nPoints = nPeriod*samples_period
+    vTvals = np.arange(nPoints)/dNewRate
+    # remove mean value, then mix down
+    avg = np.mean(vWaveform, axis=-1, keepdims=True)
+    demod = 2*(vWaveform[..., :nPoints]-avg)*np.exp(-1j*(2*np.pi*dModFreq*vTvals))
+    # integrate over each modulation period
+    shape = demod.shape[:-1] + (nPeriod, samples_period)
+    vResponse = demod.reshape(shape).mean(axis=-1)
+    return mod_period, vResponse
 
-        return mod_period, vResponse      
-      
 
 if __name__ == '__main__':
     pass
\ No newline at end of file